@@ -1,5 +1,7 @@
 '''
 ------ Instructions ------
+The script requires python 3.11 or later.
+
 Before running the script, the following parameters need to be set within the python file:
 
 1. r1_len: length of read1 (use 40 for v3, and 52 for v4). Default: 52.
@@ -19,9 +21,10 @@ Before running the script, the following parameters need to be set within the py
 15. training_max: maximal number of clusters used in the training set. Default: 50000. 
 16. training_min: minimal number of clusters used in the training set. Default: 5000. 
 17. training_ratio: ratio of reads used for training, constrained by "training_max" and "training_min". Default: 0.01. 
-18. n_threads: number of cores to use for multiprocess, if too big, memory may fail. Default: 20. 
+18. n_threads: number of cores to use for multiprocess, if too big, memory may fail. It is capped by the number of cores available to the script. Default: 20. 
 19. chunk_lines: number of lines to allocate to each core to process, if too big, memory may fail. Default: 10000. 
 20. chunk: give a feedback for proceessing this number of lines. Default: 1000000. 
+21. use_gpu: whether to decode HMM states on the GPU with cupy (in a single process, instead of 'n_threads' processes). Default: False. 
 
 This script has three modes:
 > Mode 1:
@@ -30,20 +33,23 @@ This script has three modes:
 3. a text string which indicates what to use for training HMM (-t, optional, default 'all')
 4. a reference file with annotation in bed format (-r, required)
 5. a STAR-aligned bam file (-b, required)
-6. the un-trimmed fastq file from read1 (-f1, required)
+6. the un-trimmed fastq file from read1 (-f1, optional, if not provided, read1 sequence in the bam file is used)
 7. the fastq file from read2 (-f2, optional, only if 'check_pa_tail' is 'True')
 8. intensity file from read2 (-i, required)
 9. poly(A) site annotation in bed format (-p, optional)
+10. whether to print the HMM model before and after training (-v, optional)
 > Mode 2:
 1. a text string which defines the prefix name of the output files (-n, required)
 2. a text string which specifies the output directory (-d, optional)
 3. a text string which indicates what to use for training HMM (-t, optional, default 'all')
 4. T_signal output file generated by this script (-s, required)
+5. whether to print the HMM model before and after training (-v, optional)
 > Mode 3:
 1. a text string which defines the prefix name of the output files (-n, required)
 2. a text string which specifies the output directory (-d, optional)
 3. T_signal output file generated by this script (-s, required)
-4. HMM model file output from ghmm (-m, required)
+4. HMM model file output by this script or ghmm (-m, required)
+5. whether to print the HMM model (-v, optional)
 
 Note: When using LSF, make sure to add -n 20 for multiprocessing
 
@@ -52,10 +58,12 @@ It outputs these files:
 1. all poly(A) tags
 2. median poly(A) tail length and total number of tags for each gene
 3. mean poly(A) tail length and total number of tags for each gene
-4. HMM model 
+4. HMM model (not in mode 3, where the given model file is used as it is)
 5. A temporary file containing converted T-signal will be written out on the disk to save memory usage
 	and it can be deleted in the end.
 6. A temporary file containing the HMM states of each read cycle for each cluster, which can be deleted manually.
+	It is a binary file of records, one for each cluster: the length of the cluster id (1 byte), the cluster id, 
+	the number of read cycles (4 bytes, little-endian) and the HMM state of each read cycle (1 byte each).
 
 ------ Change logs ------
 v2 change log:
@@ -132,18 +140,73 @@ v15 change log (20220905; 20221114; 20221217):
 2. Added an option to use fish or human RNA spike as training sets (-t option).
 3. Added values of global parameters (Changed to an OrderedDict class) and input arguments to the log output file.
 
+v16 change log:
+1. Intensities are parsed into numpy arrays and converted to T-signals in batches of clusters with vectorized operations, instead of per-base loops.
+2. HMM states are decoded with a vectorized viterbi in numpy for batches of reads.
+3. Replaced the master dictionary with numpy arrays (packed sequencer-id, gene, read1 sequence and QC), sorted by the packed sequencer-id
+	and searched with binary search. This takes much less memory than a dictionary of lists.
+4. fastq files are read with dnaio, which decompresses in large blocks (with ISA-L when available) and yields whole records.
+5. gz files are decompressed with ISA-L (python-isal). The intensity file is decompressed and read in background threads,
+	which feed chunks of lines to the processes converting T-signals.
+6. Mapped reads are intersected with the reference files in memory, reading the bam file with pysam (multi-threaded decompression)
+	and looking up regions in binned indexes of the bed files. samtools, bedtools and cut are no longer needed.
+7. Replaced the remaining python 2 idioms (has_key, xrange, integer division with '/'), and gz files are now read as text.
+8. Training reads in HMM only mode are sampled by reservoir sampling in one pass through the T-signal file, instead of seeking to 
+	random positions, which was very slow for gz files and favored lines following long lines.
+9. Reads are checked for a poly(A) tail in batches with numpy.
+10. T-signal lines are formatted in the worker processes (6 significant digits) and written to the T-signal file once per chunk.
+11. The read1 fastq file (-f1) is optional. Without it, read1 sequence and QC are taken from the bam file while intersecting, which
+	saves a pass through the read1 fastq file. The bam file then needs to have the un-trimmed read1.
+12. The master arrays are put in shared memory for converting intensities, and each process attaches them once when it starts.
+	The converted T-signal of each chunk is also passed back in a reused shared memory block instead of being pickled.
+13. HMM states can be decoded on the GPU with cupy ('use_gpu').
+14. HMM states are written to a binary file ('hmm_states.bin') with one byte for each state, instead of a text file of lists.
+15. Empty positions in read2 are filled in for all clusters at once, with the mean of the non-empty positions in the sliding window.
+	Before, positions were filled in one by one and earlier filled-in values were included in the mean.
+16. The intensity file is read in blocks of 1 MB and split into lines in the reader thread, instead of line by line.
+17. A single pool of processes is used for calculating tail lengths, instead of a new pool for each round of chunks.
+	The T-signal file is read in a background thread, so reading overlaps with decoding, and the kernel is asked to read ahead.
+18. Replaced ghmm with a Baum-Welch training in numpy, which runs the forward-backward algorithm for batches of sequences of the same length.
+	HMM models are read and written in the XML format of ghmm, so models trained by earlier versions can still be used in mode 3.
+19. If numba is installed, HMM states are decoded with a compiled viterbi.
+20. Each worker returns the output of a chunk as bytes, which are written to the output files at once.
+21. Tail-lengths are returned by each worker as arrays, with an integer label for each gene, instead of lists of gene_name, tail-length pairs.
+22. The terms of the emission densities that only depend on the model are computed once for each model, instead of for each chunk of T-signals.
+23. T-signals are parsed into float32 arrays, instead of lists of python floats, for training and for decoding HMM states.
+24. Plain text T-signal files are memory-mapped for prediction, and each chunk is passed to the workers as a single block of bytes.
+25. Python 3.11 or later is required.
+26. Lines read in blocks are split into chunks without copying the remaining lines for each chunk.
+27. The expected counts of the Baum-Welch training are computed in 'n_threads' processes.
+28. If numba is installed, the forward and backward variables of the Baum-Welch training are computed by compiled loops.
+29. 'n_threads' is capped by the number of cores available to the script, and numpy runs in a single thread in each process.
+30. Processes are started by a forkserver, so the script runs under "if __name__ == '__main__'", and workers get their data from the initializers of the pools.
+31. The T-signals for training are copied once into a single buffer in shared memory, which is attached by each process of the Baum-Welch training.
+32. The HMM model is only printed with the option '-v', and it is not written again in mode 3.
+
 Other changes to be made:
-1. Find a replacement for ghmm so that the script is compatible with python3
-2. Try using multiple HMM models to call tail lengths instead of a unified model for each dataset
-3. Use object-oriented programming
+1. Try using multiple HMM models to call tail lengths instead of a unified model for each dataset
+2. Use object-oriented programming
 '''
 
 
-import sys, subprocess, math, numpy, gzip, ghmm, time, tarfile, concurrent.futures, random, os, argparse, shlex
-from ghmm import *
+import sys
+if sys.version_info < (3, 11): # the specializing interpreter of python 3.11 speeds up the loops over lines and reads
+	sys.exit('Error! Python 3.11 or later is required!')
+import os
+for var in ['OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS']: # set before numpy is imported, 
+	os.environ.setdefault(var, '1') # so that each of the 'n_threads' processes runs numpy in a single thread
+import subprocess, math, struct, itertools, numpy, io, dnaio, pysam, time, tarfile, concurrent.futures, random, argparse, shlex, queue, threading, mmap
+from isal import igzip, igzip_threaded
+import multiprocessing
+from multiprocessing import shared_memory
+from xml.etree import ElementTree
+try: # numba is optional, for decoding HMM states with a compiled viterbi
+	from numba import njit
+except ImportError:
+	njit = None
 from time import time
 from datetime import datetime
-from collections import OrderedDict
+from collections import OrderedDict, deque
 
 ###------global variables-----------------------------------------------------------------
 params = OrderedDict([
@@ -170,153 +233,622 @@ params = OrderedDict([
 
 	('n_threads', 20),# number of cores to use for multiprocess, if too big, memory may fail
 	('chunk_lines', 10000), # number of lines to allocate to each core to process, if too big, memory may fail
-	('chunk', 1000000)# give a feedback for proceessing this number of lines
+	('chunk', 1000000),# give a feedback for proceessing this number of lines
+	('use_gpu', False) # whether to decode HMM states on the GPU with cupy (in a single process, instead of 'n_threads' processes)
 ])
+if hasattr(os, 'sched_getaffinity'): # no more processes than the cores the script is allowed to run on
+	params['n_threads'] = max(1, min(params['n_threads'], len(os.sched_getaffinity(0))))
+
+xp = numpy # array module for decoding HMM states
+if params['use_gpu']:
+	import cupy as xp
 
 t_start = time() # timer start
-mdict = {} # master dictionary
-dict_tl = {} # dictionary for tail length, using gene_name as key
+# master arrays, with one entry for each read, sorted by the packed sequencer-id (see 'pack_id')
+read_ids = None # packed sequencer-id of each read
+gene_ids = None # index in 'gene_names' of the gene that each read intersects
+seq_arr = None # untrimmed read1 sequence of each read, as ASCII codes
+qc_arr = None # QC of read1 of each read, as ASCII codes
+train_mask = None # whether each read is picked for training
+shm_blocks = [] # shared memory blocks holding the master arrays
+shm_out = {} # shared memory blocks for the outputs of 'worker_C2T' attached by this process, by name
+gene_names = [] # names of the genes intersected by reads
+bw_block = None # shared memory block holding the T-signals for training, attached by each process running 'expected_counts'
+bw_batches = None # batches of T-signals for training, as views of 'bw_block'
+base_code = numpy.full(256, -1, dtype = numpy.int8) # channel index of each base (A, C, G, T), looked up by its ASCII code
+base_code[numpy.frombuffer(b'ACGT', dtype = numpy.uint8)] = numpy.arange(4)
+bin_bits = 16 # bed regions are indexed in bins of 2^bin_bits bases for intersecting reads
 #qc_code = '@ABCDEFGHIJKLMNOPQRSTUVWXYZ[\\]^_`abcdefgh' #QC score coding, default is Illumina 1.5
 
 ###------functions------------------------------------------------------------------------
-def fread(file): # flexibly read in files for processing
+def fread(file, threads = 0): # flexibly read in files as text for processing
+	# gz files are decompressed with ISA-L, in 'threads' background threads if it is larger than 0
 	file = str(file)
 	if file.endswith('tar.gz'):
-		temp = tarfile.open(file, 'r:gz')
-		return temp.extractfile(temp.next())
+		return readahead(io.TextIOWrapper(untar(file)))
 	elif file.endswith('.gz'):
-		return gzip.open(file, 'rb')
+		if threads > 0:
+			return readahead(igzip_threaded.open(file, 'rt', threads = threads))
+		return readahead(igzip.open(file, 'rt'))
 	elif file.endswith('.txt'):
-		return open(file, 'r')
+		return readahead(open(file, 'r'))
+	else:
+		sys.exit("Wrong file type to read: " + file)
+
+def readahead(f): # tell the kernel that the file will be read sequentially, so it reads ahead more aggressively (if supported)
+	try:
+		os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+	except (AttributeError, OSError, ValueError):
+		pass
+	return f
+
+def untar(file): # open the first file in a tar.gz archive as a binary file
+	temp = tarfile.open(file, 'r:gz')
+	return temp.extractfile(temp.next())
+
+def fqread(file): # read in fastq files (either txt, gz or tar) as records of name, sequence and qualities
+	file = str(file)
+	if file.endswith('tar.gz'):
+		return dnaio.open(untar(file), fileformat = 'fastq')
+	elif file.endswith('.gz') or file.endswith('.txt'):
+		return dnaio.open(file, fileformat = 'fastq')
 	else:
 		sys.exit("Wrong file type to read: " + file)
 	
-def Convert2T(line):
-# this function does two things:
+def read_chunks(f, chunk_queue, n_lines):
+# this function reads a file in chunks of n_lines lines and puts them in a queue, followed by an empty chunk at the end
+# it runs in a separate thread, so that reading the file overlaps with processing the chunks
+# the file is read in blocks of 1 MB, which are split into lines (without the line breaks)
+	try:
+		line_lst = []
+		rest = '' # incomplete last line of the previous block
+		while(1):
+			block = f.read(1 << 20)
+			if not block:
+				break
+			lines = (rest + block).split('\n')
+			rest = lines.pop()
+			line_lst.extend(lines)
+			n = len(line_lst) - len(line_lst) % n_lines # lines in full chunks
+			for i in range(0, n, n_lines): # each line is copied once into its chunk
+				chunk_queue.put(line_lst[i:i + n_lines])
+			del line_lst[:n] # and the remaining lines are moved once for each block
+		if rest:
+			line_lst.append(rest)
+		if line_lst:
+			chunk_queue.put(line_lst)
+		chunk_queue.put([])
+	except Exception as e: # pass the error on to the thread processing the chunks
+		chunk_queue.put(e)
+
+def map_chunks(file, chunk_queue, n_lines):
+# this function does the same as 'read_chunks' for a plain text file, but each chunk is put in the queue as a single block of bytes
+# the file is memory-mapped and line breaks are found with 'find' (memchr), so no python object is made for each line here
+	try:
+		with open(file, 'rb') as f:
+			if os.fstat(f.fileno()).st_size > 0: # empty files can't be memory-mapped
+				with mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ) as mm:
+					try:
+						mm.madvise(mmap.MADV_SEQUENTIAL)
+					except (AttributeError, OSError):
+						pass
+					start = 0
+					while start < len(mm):
+						end = start
+						for i in range(n_lines):
+							end = mm.find(b'\n', end) + 1
+							if end == 0: # the last line has no line break
+								end = len(mm)
+								break
+							if end == len(mm):
+								break
+						chunk_queue.put(mm[start:end])
+						start = end
+		chunk_queue.put(b'')
+	except Exception as e:
+		chunk_queue.put(e)
+
+def read_bed(file):
+# this function reads in regions from a bed file (either txt or gz) and returns an index for 'find_overlaps' as 
+# {(chromosome, strand): {bin: [(start, end, name), ...]}}, in which each region is listed in all bins of 2^bin_bits bases that it covers
+	index = {}
+	with (igzip.open(file, 'rt') if file.endswith('.gz') else open(file, 'r')) as f:
+		for line in f:
+			lst = line.rstrip('\n').split('\t')
+			if len(lst) < 3 or lst[0].startswith(('#', 'track', 'browser')):
+				continue
+			region = (int(lst[1]), int(lst[2]), lst[3] if len(lst) > 3 else '')
+			bins = index.setdefault((lst[0], lst[5] if len(lst) > 5 else '.'), {})
+			for b in range(region[0] >> bin_bits, ((max(region[1], region[0] + 1) - 1) >> bin_bits) + 1):
+				bins.setdefault(b, []).append(region)
+	return index
+
+def find_overlaps(index, chrom, strand, start, end):
+# this function returns the names of all regions in an index from 'read_bed' that overlap with [start, end) on a chromosome and strand
+	bins = index.get((chrom, strand))
+	names = []
+	if bins:
+		for b in range(start >> bin_bits, ((end - 1) >> bin_bits) + 1):
+			for region in bins.get(b, ()):
+				if region[0] < end and start < region[1] and b == max(start, region[0]) >> bin_bits:
+				# a region in several bins is only reported from the first bin that it shares with [start, end)
+					names.append(region[2])
+	return names
+
+def pack_id(idx):
+# this function packs a sequencer-id (tile, x and y of a cluster, as a list of strings) into a single integer
+# the tile takes 22 bits and x and y take 21 bits each, so it exits if the tile is not below 4194304 or a coordinate is not below 2097152,
+# instead of letting the fields overlap
+	tile, x, y = int(idx[0]), int(idx[1]), int(idx[2])
+	if not (0 <= tile < 1 << 22 and 0 <= x < 1 << 21 and 0 <= y < 1 << 21):
+		sys.exit('Error! The sequencer-id ' + ':'.join(idx) + ' is out of range (tile below 4194304, x and y below 2097152)!')
+	return (tile << 42) | (x << 21) | y
+
+def find_reads(keys):
+# this function takes a list of packed sequencer-ids and returns the indices of the reads in the master arrays
+# -1 is returned for reads that are not in the master arrays
+	keys = numpy.asarray(keys, dtype = numpy.uint64)
+	rows = numpy.searchsorted(read_ids, keys)
+	found = rows < len(read_ids)
+	found[found] = read_ids[rows[found]] == keys[found]
+	return numpy.where(found, rows, -1)
+
+def Convert2T(intensities, bases):
+# this function converts the intensities of a batch of clusters to T signals
+# intensities: array of (clusters, positions, 4 channels), in which the first positions are the part of read1 for normalization
+# and the rest are the positions in read2 to be converted
+# bases: array of (clusters, positions) with the channel of each base of read1 for normalization, -1 if it is not A, C, G or T
+# it outputs an array of T signals (clusters, positions) and a boolean array indicating which clusters are converted
+# the conversion does two things:
 # 1. normalize intensity for all four channels of each cluster, using part of read1 
-	dict_value = {'A':[] ,'C':[] ,'G':[], 'T':[]}
-	lst = line.strip('\n').split('\t')
-	idx = ':'.join(lst[:3])
-	for i in range(params['r1_nor_start'], params['r1_nor_end']+1): # i is the i-th base in read1 
-		lst4c = map(int, [x for x in lst[i-1+4].split(' ') if x != '']) 
-		# first 4 elements are not intensities
-		# get rid of spaces between intensity values
-		dict_4c = {'A':lst4c[0] ,'C':lst4c[1] ,'G':lst4c[2], 'T':lst4c[3]}
-		base = mdict[idx][1][i-1]
-		qc = mdict[idx][2][i-1]
-		if dict_value.has_key(base) \
-		and dict_4c[base] > 0:
-		#and qc_code.index(qc) >= qc_cutoff:
-		# QC must be better than qc_cutoff
-			dict_value[base].append(dict_4c[base]) 
-	for key in dict_value:
-		if len(dict_value[key]) == 0:
-			return None
-			# exit this function if normalization can't be completed
-		else:
-			dict_value[key] = numpy.mean(dict_value[key])
-			# otherwise, take the average value
-			# this should be the approximate value illumina used to call the base for that cluster
+	n_nor = bases.shape[1]
+	values = numpy.take_along_axis(intensities[:, :n_nor], numpy.maximum(bases, 0)[:, :, None], axis = 2)[:, :, 0]
+	dict_value = numpy.zeros((len(bases), 4))
+	counts = numpy.zeros((len(bases), 4))
+	for i in range(4):
+		mask = (bases == i) & (values > 0)
+		dict_value[:, i] = numpy.where(mask, values, 0).sum(axis = 1)
+		counts[:, i] = mask.sum(axis = 1)
+	valid = (counts > 0).all(axis = 1)
+	# clusters are discarded if normalization can't be completed
+	dict_value[valid] /= counts[valid]
+	dict_value[~valid] = 1.0
+	# otherwise, take the average value of each channel
+	# this should be the approximate value illumina used to call the base for that cluster
 # 2. convert intensity from 4 channels to T signal
-	all_T = []
-	for j in range(5 + params['r1_len'] + params['dis2T'], len(lst)+1): # j is j-th position in intensity line
-		lst4c = map(int, [x for x in lst[j-1].split(' ') if x != ''])
-		if lst4c == [0,0,0,0]:
-			all_T.append('empty')
-		# sometimes in a base position, all channel signals equal to 0
-		# these need to be corrected later or discarded if there are too many in a cluster
-		else:
-			dict_4c = {'A':lst4c[0] ,'C':lst4c[1] ,'G':lst4c[2], 'T':lst4c[3]}
-			for key in dict_4c:
-				if dict_4c[key] <= 0:
-					dict_4c[key] = 1.0 / dict_value[key]
-				else:
-					dict_4c[key] = float(dict_4c[key]) / dict_value[key]
-				# normalize the intensity value 
-			T_signal = dict_4c['T'] / (dict_4c['A'] + dict_4c['C'] + dict_4c['G'])
-			T_signal = math.log(T_signal, 2)
-			T_signal = max(-params['bound'], min(T_signal, params['bound']))
-			# make large or small T_signal bound
-			all_T.append(T_signal)
-	if all_T.count('empty') >= params['all_zero_limit']:
-		return None
-	else:
-		for k in range(len(all_T)):
-			if all_T[k] == 'empty':
-				sliding_T = all_T[max(0, k - params['all_zero_limit']):min(len(all_T), k + params['all_zero_limit'])]
-				sliding_T = [x for x in sliding_T if x != 'empty']
-				all_T[k] = numpy.mean(sliding_T)
-		# if there more than all_zero_limit base positions with all channel signals being equal to 0, discard this cluster
-		# else, use the mean in a sliding window to fill in the missing value
-	all_T.insert(0, params['bound']*100) # add a peudo T to the front, making sure HMM starts with T
-	return all_T
-
-def worker_C2T(lines):
+	arr = intensities[:, n_nor:].astype(numpy.float64)
+	empty = ~arr.any(axis = 2)
+	# sometimes in a base position, all channel signals equal to 0
+	# these need to be corrected later or discarded if there are too many in a cluster
+	valid &= empty.sum(axis = 1) < params['all_zero_limit']
+	arr[arr <= 0] = 1.0
+	nA, nC, nG, nT = (1.0 / dict_value.T)[:, :, None] # reciprocals of the channel means, so normalizing is a multiplication
+	A, C, G, T = arr.transpose(2, 0, 1) # (clusters, positions) view of each channel
+	all_T = numpy.empty((len(arr), arr.shape[1] + 1))
+	all_T[:, 0] = params['bound']*100 # add a peudo T to the front, making sure HMM starts with T
+	numpy.divide(T * nT, A * nA + C * nC + G * nG, out = all_T[:, 1:]) # normalize the intensity value
+	# all normalized values are positive, so the ratio is always defined
+	numpy.log2(all_T[:, 1:], out = all_T[:, 1:])
+	numpy.clip(all_T[:, 1:], -params['bound'], params['bound'], out = all_T[:, 1:])
+	# make large or small T_signal bound
+	rows = (empty & valid[:, None]).any(axis = 1).nonzero()[0]
+	if len(rows):
+		seen = ~empty[rows]
+		sums = numpy.zeros((len(rows), empty.shape[1] + 1)) # cumulative sums of the T signals and counts of non-empty positions
+		counts = numpy.zeros((len(rows), empty.shape[1] + 1))
+		numpy.cumsum(numpy.where(seen, all_T[rows, 1:], 0), axis = 1, out = sums[:, 1:])
+		numpy.cumsum(seen, axis = 1, out = counts[:, 1:])
+		k = numpy.arange(empty.shape[1])
+		start, end = numpy.maximum(k - params['all_zero_limit'], 0), numpy.minimum(k + params['all_zero_limit'], empty.shape[1])
+		with numpy.errstate(invalid = 'ignore', divide = 'ignore'):
+			all_T[rows, 1:] = numpy.where(seen, all_T[rows, 1:], (sums[:, end] - sums[:, start]) / (counts[:, end] - counts[:, start]))
+	# if there more than all_zero_limit base positions with all channel signals being equal to 0, discard this cluster
+	# else, use the mean of the non-empty positions in a sliding window to fill in the missing value
+	return all_T, valid
+
+def share_arrays(arrays):
+# this function copies numpy arrays into shared memory blocks
+# and outputs a list of the blocks, a list of views of the arrays in the blocks, 
+# and a list of (name, shape, dtype) of the blocks for attaching them in other processes
+	blocks, views, specs = [], [], []
+	for arr in arrays:
+		shm = shared_memory.SharedMemory(create = True, size = max(arr.nbytes, 1))
+		view = numpy.ndarray(arr.shape, dtype = arr.dtype, buffer = shm.buf)
+		view[:] = arr
+		blocks.append(shm)
+		views.append(view)
+		specs.append((shm.name, arr.shape, arr.dtype.str))
+	return blocks, views, specs
+
+def init_C2T(specs, names):
+# this function initializes each process converting intensities
+# by attaching the master arrays in shared memory, so they are not copied or pickled for each process
+	global read_ids, gene_ids, seq_arr, train_mask, gene_names, shm_blocks
+	shm_blocks = [shared_memory.SharedMemory(name = name) for name, shape, dtype in specs]
+	read_ids, gene_ids, seq_arr, train_mask = [numpy.ndarray(shape, dtype = dtype, buffer = shm.buf) for shm, (name, shape, dtype) in zip(shm_blocks, specs)]
+	gene_names = names
+
+def worker_C2T(lines, slot = None):
 # this function takes all read2 intensity lines allocated to each process
+# and optionally a (name, size) of a shared memory block for the output
 # and outputs a tupple including
-# 1. a new dictionary which only contains gene_name and converted T-signal
-# 2. a list containing converted T-signals to be trained
-	temp_dict = {}
+# 1. a text block of the reads with converted T-signal, one read per line (read id, gene_name and T-signal, tab-delimited),
+# 	as bytes, or the number of bytes written to the shared memory block if the text block fits in it
+# 2. the number of reads in the text block
+# 3. a list containing converted T-signals to be trained, as float32 arrays
+	temp_out = []
 	temp_lst = []
-	for line in lines:	
-		idx = ':'.join(line.strip('\n').split('\t')[:3])
-		if mdict.has_key(idx):
-			temp = Convert2T(line)
-			if temp: # only reads that have converted T-signal will be used later			
-				temp_dict.setdefault(idx, [mdict[idx][0],temp])
-				if idx in train_keys:
-					temp_lst.append(temp)
-	return temp_dict, temp_lst
+	batches = {} # lines of reads in the master arrays, grouped by the number of positions
+	lsts = [line.strip('\n').split('\t') for line in lines]
+	for i, lst in zip(find_reads([pack_id(lst[:3]) for lst in lsts]), lsts):
+		if i >= 0:
+			batches.setdefault(len(lst), []).append((i, lst))
+	for batch in batches.values():
+		n_nor = params['r1_nor_end'] - params['r1_nor_start'] + 1
+		intensities = numpy.empty((len(batch), n_nor + len(batch[0][1]) - 4 - params['r1_len'] - params['dis2T'], 4), dtype = numpy.int32)
+		for j, (i, lst) in enumerate(batch):
+			intensities[j] = numpy.fromstring(' '.join(lst[params['r1_nor_start']-1+4:params['r1_nor_end']+4] + lst[4 + params['r1_len'] + params['dis2T']:]), 
+				sep = ' ', dtype = numpy.int32).reshape(-1, 4)
+			# first 4 elements are not intensities
+			# each row holds the intensities of the four channels (A, C, G, T) of one base position
+		rows = numpy.array([i for i, lst in batch])
+		bases = base_code[seq_arr[rows, params['r1_nor_start']-1:params['r1_nor_end']]]
+		all_T, valid = Convert2T(intensities, bases)
+		line_fmt = '%s\t%s' + '\t%.6g' * all_T.shape[1] + '\n' # the whole line is formatted at once
+		for j in valid.nonzero()[0]: # only reads that have converted T-signal will be used later
+			i, lst = batch[j]
+			temp_out.append(line_fmt % (':'.join(lst[:3]), gene_names[gene_ids[i]], *all_T[j].tolist()))
+			if train_mask[i]:
+				temp_lst.append(all_T[j].astype(numpy.float32))
+	out = ''.join(temp_out).encode()
+	if slot and len(out) <= slot[1]: # the text block is passed back in shared memory instead of being pickled
+		if slot[0] not in shm_out:
+			shm_out[slot[0]] = shared_memory.SharedMemory(name = slot[0])
+		shm_out[slot[0]].buf[:len(out)] = out
+		out = len(out)
+	return out, len(temp_out), temp_lst
+
+def hmm_arrays(A, B, pi):
+# this function takes the transition matrix, the emission matrix and the initial probabilities of a gaussian (mixture) HMM, 
+# in the format of ghmm, and outputs its parameters as a dictionary of numpy arrays in log space
+# emissions are stored as separate contiguous (states, components) arrays of means, variances and weights, 
+# with one component for a simple gaussian model
+	B = numpy.array(B, dtype = numpy.float64)
+	if B.ndim == 2: # [mean, variance] of each state
+		B = numpy.stack([B[:, :1], B[:, 1:], numpy.ones((len(B), 1))], axis = 1)
+	# otherwise, [means, variances, weights] of the components of each state
+	with numpy.errstate(divide = 'ignore'):
+		return emission_terms({'log_pi': numpy.log(numpy.array(pi, dtype = numpy.float64)), 'log_A': numpy.log(numpy.array(A, dtype = numpy.float64)), 
+			'mu': numpy.ascontiguousarray(B[:, 0]), 'var': numpy.ascontiguousarray(B[:, 1]), 'log_w': numpy.log(B[:, 2])})
+
+def emission_terms(hmm):
+# this function takes the model from 'hmm_arrays' and adds the terms of the log densities of the gaussian components
+# that only depend on the model, so that they are computed once for all T-signals (see 'log_emissions')
+# 1. 'neg_half_inv_var': -0.5 / variance
+# 2. 'log_norm': log weight - 0.5 * log(2 * pi * variance)
+	hmm['neg_half_inv_var'] = -0.5 / hmm['var']
+	hmm['log_norm'] = hmm['log_w'] - 0.5 * numpy.log(2 * numpy.pi * hmm['var'])
+	return hmm
+
+def log_emissions(obs, hmm):
+# this function takes T-signals (of any shape) and the model from 'hmm_arrays' and outputs a tupple including
+# 1. the log densities of the gaussian components of each state (..., states, components)
+# 2. the log emission probabilities of each state (..., states), summed over the components with the log-sum-exp trick
+# only numpy ufuncs and array methods are used, so that it works for cupy arrays as well
+	with numpy.errstate(divide = 'ignore', under = 'ignore', invalid = 'ignore'):
+		log_c = (obs[..., None, None] - hmm['mu'])**2 * hmm['neg_half_inv_var'] + hmm['log_norm']
+		c_max = log_c.max(axis = -1)
+		c_max[c_max == -numpy.inf] = 0
+		return log_c, numpy.log(numpy.exp(log_c - c_max[..., None]).sum(axis = -1)) + c_max
+
+def scaled_forward(b, A, pi, alpha, scale):
+# this function takes scaled emission probabilities (sequences, positions, states), transition and initial probabilities
+# and fills in the forward variables (sequences, positions, states), scaled to sum to 1 at each position, and the scale factors (sequences, positions)
+# it loops over sequences, positions and states, so that the forward variables of a position stay in registers, 
+# and is only used when compiled with numba (see 'forward_backward')
+	n_states = b.shape[2]
+	for n in range(b.shape[0]):
+		total = 0.0
+		for j in range(n_states):
+			alpha[n, 0, j] = pi[j] * b[n, 0, j]
+			total += alpha[n, 0, j]
+		scale[n, 0] = total
+		for j in range(n_states):
+			alpha[n, 0, j] /= total
+		for t in range(1, b.shape[1]):
+			total = 0.0
+			for j in range(n_states):
+				temp = 0.0
+				for i in range(n_states):
+					temp += alpha[n, t-1, i] * A[i, j]
+				alpha[n, t, j] = temp * b[n, t, j]
+				total += alpha[n, t, j]
+			scale[n, t] = total
+			for j in range(n_states):
+				alpha[n, t, j] /= total
+
+def scaled_backward(b, A, scale, beta):
+# this function takes scaled emission probabilities (sequences, positions, states), transition probabilities and 
+# the scale factors from 'scaled_forward', and fills in the backward variables (sequences, positions, states)
+# it is only used when compiled with numba (see 'forward_backward')
+	n_states = b.shape[2]
+	for n in range(b.shape[0]):
+		for i in range(n_states):
+			beta[n, -1, i] = 1.0
+		for t in range(b.shape[1] - 2, -1, -1):
+			for i in range(n_states):
+				temp = 0.0
+				for j in range(n_states):
+					temp += A[i, j] * b[n, t+1, j] * beta[n, t+1, j]
+				beta[n, t, i] = temp / scale[n, t+1]
+
+if njit: # divisions by zero give inf or nan as in numpy, for sequences that can't be generated by the model
+	scaled_forward = njit(cache = True, nogil = True, error_model = 'numpy')(scaled_forward)
+	scaled_backward = njit(cache = True, nogil = True, error_model = 'numpy')(scaled_backward)
+
+def forward_backward(obs, hmm):
+# this function takes a batch of T-signals of the same length (sequences, positions) and the model from 'hmm_arrays' 
+# and outputs a tupple including
+# 1. the log-likelihood of each sequence, -inf if the sequence can't be generated by the model
+# 2. the posterior probabilities of the gaussian components of each state (sequences, positions, states, components)
+# 3. the expected numbers of transitions (states, states), summed over all sequences
+# the forward and backward variables are scaled to sum to 1 at each position, 
+# and computed by the compiled 'scaled_forward' and 'scaled_backward' with numba, otherwise for all sequences together at each position
+	log_c, log_b = log_emissions(obs, hmm)
+	with numpy.errstate(divide = 'ignore', under = 'ignore', invalid = 'ignore'):
+		b_max = log_b.max(axis = 2, keepdims = True)
+		b_max[numpy.isneginf(b_max)] = 0
+		b = numpy.exp(log_b - b_max) # emission probabilities, scaled at each position
+		A = numpy.exp(hmm['log_A'])
+		alpha = numpy.empty(b.shape)
+		scale = numpy.empty(b.shape[:2])
+		if njit:
+			scaled_forward(b, A, numpy.exp(hmm['log_pi']), alpha, scale)
+		else:
+			alpha[:, 0] = numpy.exp(hmm['log_pi']) * b[:, 0]
+			scale[:, 0] = alpha[:, 0].sum(axis = 1)
+			alpha[:, 0] /= scale[:, 0, None]
+			for t in range(1, b.shape[1]):
+				alpha[:, t] = (alpha[:, t-1] @ A) * b[:, t]
+				scale[:, t] = alpha[:, t].sum(axis = 1)
+				alpha[:, t] /= scale[:, t, None]
+		log_p = numpy.log(scale).sum(axis = 1) + b_max[:, :, 0].sum(axis = 1)
+		bad = ~(scale > 0).all(axis = 1) # sequences that can't be generated by the model
+		alpha[bad] = 0
+		scale[bad] = 1
+		log_p[bad] = -numpy.inf
+		beta = numpy.empty(b.shape)
+		if njit:
+			scaled_backward(b, A, scale, beta)
+		else:
+			beta[:, -1] = 1
+			for t in range(b.shape[1] - 2, -1, -1):
+				beta[:, t] = ((b[:, t+1] * beta[:, t+1]) @ A.T) / scale[:, t+1, None]
+		n_A = A * numpy.einsum('nti,ntj->ij', alpha[:, :-1], b[:, 1:] * beta[:, 1:] / scale[:, 1:, None])
+		gamma = (alpha * beta)[..., None] * numpy.nan_to_num(numpy.exp(log_c - log_b[..., None]))
+	return log_p, gamma, n_A
+
+def init_baum_welch(spec, bounds):
+# this function initializes each process of the Baum-Welch training by attaching the T-signals for training in shared memory
+# (see 'share_arrays'), and takes each batch (start, number of sequences, length) as a view of them, so they are not copied or pickled
+	global bw_block, bw_batches
+	name, shape, dtype = spec
+	bw_block = shared_memory.SharedMemory(name = name)
+	signals = numpy.ndarray(shape, dtype = dtype, buffer = bw_block.buf)
+	bw_batches = [signals[start:start + n * length].reshape(n, length) for start, n, length in bounds]
+
+def expected_counts(i, hmm):
+# this function takes the index of a batch in 'bw_batches' and the model from 'hmm_arrays' and outputs a tupple including
+# 1. the log-likelihood of the batch, leaving out sequences that can't be generated, as in ghmm
+# 2-6. the expected numbers of initial states and transitions, and the expected weights, sums and sums of squares 
+# of T-signals of the gaussian components, summed over the sequences in the batch
+	obs = bw_batches[i]
+	log_p, gamma, n_A = forward_backward(obs, hmm)
+	return (log_p[numpy.isfinite(log_p)].sum(), gamma[:, 0].sum(axis = (0, 2)), n_A, gamma.sum(axis = (0, 1)), 
+		numpy.einsum('ntkm,nt->km', gamma, obs), numpy.einsum('ntkm,nt->km', gamma, obs**2))
+
+def baum_welch(hmm, train_set, n_steps, cutoff, n_threads = 1):
+# this function takes the model from 'hmm_arrays' and a list of T-signal sequences (arrays or lists of floats) for training
+# and outputs the model re-estimated by the Baum-Welch algorithm, after n_steps steps or when the log-likelihood
+# improves by less than cutoff times its absolute value, as 'baumWelch' in ghmm
+# sequences of the same length are processed together, in batches of up to 1000 sequences,
+# and the expected counts of the batches are computed in n_threads processes and summed up in each step
+# all sequences are copied once into a single contiguous buffer in shared memory, grouped by length, so that each batch is a view of it
+	lengths = numpy.array([len(seq) for seq in train_set])
+	order = numpy.argsort(lengths, kind = 'stable')
+	blocks, views, specs = share_arrays([numpy.concatenate([train_set[i] for i in order], dtype = numpy.float64)])
+	del views
+	bounds = [] # (start, number of sequences, length) of each batch in the buffer
+	start = 0
+	for length, count in zip(*numpy.unique(lengths, return_counts = True)):
+		length, count = int(length), int(count)
+		k = min(1000, -(-count // n_threads)) # so that each process gets a batch
+		bounds.extend((start + n * length, min(k, count - n), length) for n in range(0, count, k))
+		start += count * length
+	log_p_old = -numpy.inf
+	with concurrent.futures.ProcessPoolExecutor(n_threads, initializer = init_baum_welch, initargs = (specs[0], bounds)) as pool:
+		for step in range(n_steps):
+			counts = pool.map(expected_counts, range(len(bounds)), itertools.repeat(hmm, len(bounds)))
+			log_p, n_pi, n_A, n_w, n_x, n_xx = [sum(count) for count in zip(*counts)] # accumulate the expected counts of all sequences
+			with numpy.errstate(divide = 'ignore', invalid = 'ignore'):
+			# states or components that are never visited keep their parameters
+				mu = numpy.where(n_w > 0, n_x / n_w, hmm['mu'])
+				hmm = emission_terms({'log_pi': numpy.log(n_pi / n_pi.sum()),
+					'log_A': numpy.where(n_A.sum(axis = 1, keepdims = True) > 0, numpy.log(n_A / n_A.sum(axis = 1, keepdims = True)), hmm['log_A']),
+					'mu': mu,
+					'var': numpy.where(n_w > 0, numpy.maximum(n_xx / n_w - mu**2, 1e-4), hmm['var']), # variances are kept above 1e-4, as in ghmm
+					'log_w': numpy.where(n_w.sum(axis = 1, keepdims = True) > 0, numpy.log(n_w / n_w.sum(axis = 1, keepdims = True)), hmm['log_w'])})
+			if log_p - log_p_old < cutoff * abs(log_p):
+				break
+			log_p_old = log_p
+	blocks[0].close()
+	blocks[0].unlink()
+	return hmm
+
+def hmm_xml(hmm):
+# this function takes the model from 'hmm_arrays' and outputs it as text in the XML format of ghmm: 
+# the initial probability and the gaussian components (mean, variance and weight) of each state, and the transition probabilities
+	pi, A, w = numpy.exp(hmm['log_pi']), numpy.exp(hmm['log_A']), numpy.exp(hmm['log_w'])
+	lines = ['<?xml version="1.0" encoding="UTF-8"?>', '<mixture version="1.0" noComponents="1">', '<HMM type="continuous">']
+	for i in range(len(pi)):
+		lines.append('<state id="%d" initial="%r">' % (i, float(pi[i])))
+		lines.append('<mixture>')
+		for j in range(w.shape[1]):
+			lines.append('<normal mean="%r" variance="%r" prior="%r"/>' % (float(hmm['mu'][i, j]), float(hmm['var'][i, j]), float(w[i, j])))
+		lines.append('</mixture>')
+		lines.append('</state>')
+	for i, j in zip(*A.nonzero()):
+		lines.append('<transition source="%d" target="%d">' % (i, j))
+		lines.append('<probability>%r</probability>' % float(A[i, j]))
+		lines.append('</transition>')
+	lines.append('</HMM>')
+	lines.append('</mixture>')
+	return '\n'.join(lines) + '\n'
+
+def read_hmm(file):
+# this function reads a gaussian (mixture) HMM in the XML format of ghmm (see 'hmm_xml') and outputs the model from 'hmm_arrays'
+	root = ElementTree.parse(file).getroot()
+	states = sorted(root.iter('state'), key = lambda x: int(x.get('id')))
+	index = {state.get('id'): i for i, state in enumerate(states)}
+	pi = [float(state.get('initial', 0)) for state in states]
+	B = []
+	for state in states:
+		comps = list(state.iter('normal'))
+		B.append([[float(c.get('mean')) for c in comps], [float(c.get('variance')) for c in comps], [float(c.get('prior', 1.0 / len(comps))) for c in comps]])
+	n_comps = max([len(b[0]) for b in B])
+	for b in B: # states with fewer components are padded with components of weight 0
+		b[0] += [0.0] * (n_comps - len(b[0]))
+		b[1] += [1.0] * (n_comps - len(b[1]))
+		b[2] += [0.0] * (n_comps - len(b[2]))
+	A = numpy.zeros((len(states), len(states)))
+	for trans in root.iter('transition'):
+		A[index[trans.get('source')], index[trans.get('target')]] = float(trans.findtext('probability'))
+	return hmm_arrays(A, B, pi)
+
+def viterbi_paths(log_b, log_A, log_pi, states, log_p):
+# this function takes log emission probabilities (sequences, positions, states), log transition and log initial probabilities
+# and fills in the most likely HMM states (sequences, positions) and the log probability of the path of each sequence
+# it loops over sequences, positions and states, and is compiled with numba if available (see 'viterbi')
+	n_states = log_b.shape[2]
+	psi = numpy.zeros((log_b.shape[1], n_states), dtype = numpy.int8) # best previous state of each state at each position
+	delta = numpy.empty(n_states) # log probability of the best path ending in each state
+	temp = numpy.empty(n_states)
+	for n in range(log_b.shape[0]):
+		for j in range(n_states):
+			delta[j] = log_pi[j] + log_b[n, 0, j]
+		for t in range(1, log_b.shape[1]):
+			for j in range(n_states):
+				best = 0
+				for i in range(1, n_states):
+					if delta[i] + log_A[i, j] > delta[best] + log_A[best, j]:
+						best = i
+				psi[t, j] = best
+				temp[j] = delta[best] + log_A[best, j] + log_b[n, t, j]
+			delta[:] = temp
+		best = 0
+		for j in range(1, n_states):
+			if delta[j] > delta[best]:
+				best = j
+		log_p[n] = delta[best]
+		states[n, -1] = best
+		for t in range(log_b.shape[1] - 1, 0, -1): # trace back the best path
+			states[n, t-1] = psi[t, states[n, t]]
+
+if njit:
+	viterbi_paths = njit(cache = True, nogil = True)(viterbi_paths)
+
+def viterbi(obs, hmm):
+# this function takes a batch of T-signals of the same length (sequences, positions) and the model from 'hmm_arrays' 
+# and outputs the most likely HMM states (sequences, positions) and the log probability of the path of each sequence
+# with numba, sequences are decoded by the compiled 'viterbi_paths', otherwise all sequences are decoded together at each position, 
+# with arrays from 'xp' (on the GPU if 'use_gpu' is True)
+	log_b = log_emissions(obs, hmm)[1] # log emission probabilities (sequences, positions, states)
+	if njit and xp is numpy: # the compiled viterbi decodes one sequence at a time without temporary arrays
+		states = numpy.empty(log_b.shape[:2], dtype = numpy.int8)
+		log_p = numpy.empty(len(log_b))
+		viterbi_paths(log_b, hmm['log_A'], hmm['log_pi'], states, log_p)
+		return states, log_p
+	psi = xp.zeros(log_b.shape, dtype = xp.int8) # best previous state of each state at each position
+	delta = hmm['log_pi'] + log_b[:, 0] # log probability of the best path ending in each state
+	for t in range(1, log_b.shape[1]):
+		trans = delta[:, :, None] + hmm['log_A']
+		psi[:, t] = trans.argmax(axis = 1)
+		delta = trans.max(axis = 1) + log_b[:, t]
+	states = xp.empty(log_b.shape[:2], dtype = xp.int8)
+	states[:, -1] = delta.argmax(axis = 1)
+	for t in range(log_b.shape[1] - 1, 0, -1): # trace back the best path
+		states[:, t-1] = xp.take_along_axis(psi[:, t], states[:, t, None], axis = 1)[:, 0]
+	return states, delta.max(axis = 1)
 
 def worker_hmm(lines):
-# this function takes a number of ids and calculates the tail length associated
+# this function takes a number of ids (a list of lines, or a block of lines as bytes from 'map_chunks') and calculates the tail length associated
 # with each id, and returns a tupple
-# 1. a new dictionary which contains gene_name, tail-length and all ghmm states
-# 2. a list containing gene_name and tail-length pairs 
-	temp_dict = {}
-	temp_lst = []
+# 1. the lines of the output file of all tags (gene_name, id and tail-length), as bytes
+# 2. the records of the binary file of HMM states, as bytes
+# 3. a list of gene_names in the order they first appear
+# 4. an array of the integer label of the gene_name for each tail-length (index in the list above)
+# 5. an array of tail-lengths
+	out_all = []
+	out_states = []
+	genes = {} # gene_name: integer label
+	labels = []
+	tails = []
+	batches = {} # [id, gene_name, T signals] of lines, grouped by the number of T signals, which are decoded together
+	if isinstance(lines, bytes):
+		lines = lines.decode().splitlines()
 	for line in lines:
-		l = line.strip('\n').split('\t')
-		states = model.viterbi(EmissionSequence(F, map(float,l[2:])))[0]
-		# tail length defined as the distance between two positions:
-		# 1. start_idx: the last non-T base within the non_T_limit range 
-		# 2. end_idx: the first non-T base outside the non_T_limit range
-		# Also, the first position is a peudo-T base
-		if len(states) == 0:
+		l = line.strip('\n').split('\t', 2)
+		l[2] = numpy.fromstring(l[2], dtype = numpy.float32, sep = '\t') # T-signals are written with 6 significant digits, which float32 holds
+		batches.setdefault(len(l[2]), []).append(l)
+	for batch in batches.values():
+		states_batch, log_p = viterbi(xp.asarray(numpy.stack([l[2] for l in batch])), hmm)
+		if xp is not numpy: # copy the results back from the GPU
+			states_batch, log_p = states_batch.get(), log_p.get()
+		if numpy.isneginf(log_p).any():
 			sys.exit("Can't infer the states from the model! Exiting...")
-		end_idx = len(states)
-		start_idx = 0
-		non_A_index_lst = [i for i, x in enumerate(states) if x > ((model.N - 1) / 2)]
-		for i in xrange(len(non_A_index_lst)):
-			if non_A_index_lst[i] <= params['non_T_limit']:
-				start_idx = non_A_index_lst[i]
-			else:
-				end_idx = non_A_index_lst[i]
-				break
-		tl = end_idx - start_idx - 1
-		temp_dict.setdefault(l[0], [l[1], str(tl), str(states)])
-		temp_lst.append([l[1], tl])
-	return temp_dict, temp_lst
+		for l, states, states_arr in zip(batch, states_batch.tolist(), states_batch):
+			# tail length defined as the distance between two positions:
+			# 1. start_idx: the last non-T base within the non_T_limit range 
+			# 2. end_idx: the first non-T base outside the non_T_limit range
+			# Also, the first position is a peudo-T base
+			end_idx = len(states)
+			start_idx = 0
+			non_A_index_lst = [i for i, x in enumerate(states) if x > ((len(hmm['log_pi']) - 1) // 2)]
+			for i in range(len(non_A_index_lst)):
+				if non_A_index_lst[i] <= params['non_T_limit']:
+					start_idx = non_A_index_lst[i]
+				else:
+					end_idx = non_A_index_lst[i]
+					break
+			tl = end_idx - start_idx - 1
+			key = l[0].encode()
+			out_all.append(l[1] + '\t' + l[0] + '\t' + str(tl) + '\n')
+			out_states.append(struct.pack('<B', len(key)) + key + struct.pack('<I', len(states)) + states_arr.astype(numpy.uint8).tobytes())
+			labels.append(genes.setdefault(l[1], len(genes)))
+			tails.append(tl)
+	return ''.join(out_all).encode(), b''.join(out_states), list(genes), numpy.array(labels, dtype = numpy.int32), numpy.array(tails, dtype = numpy.float32)
+
+def init_hmm(model):
+# this function initializes each process decoding HMM states with the model from 'hmm_arrays', which is only passed once
+	global hmm
+	hmm = model
 
 def lines_sampler(filename, n_lines_sample):
 	# this function takes in the reads_wTsignal file and
-	# randomly select n_lines_sample lines to output as a list of lists (each containing T signals)
-	sample = []
+	# randomly select n_lines_sample lines to output as a list of float32 arrays (each containing T signals)
+	# lines are picked by reservoir sampling (Algorithm L) in a single pass through the file, 
+	# which works as well for gz files and only draws random numbers for the lines that enter the reservoir
 	with fread(filename) as f:
-		f.seek(0, 2)
-		filesize = f.tell()
-		random_set = sorted(random.sample(xrange(filesize), n_lines_sample))
-		for i in xrange(n_lines_sample):
-			f.seek(random_set[i])
-			
-			# Skip current line (because we might be in the middle of a line) 
-			f.readline()
-			
-			# Append the next line to the sample set 
-			line = f.readline()
-			if line:
-				sample.append(list(map(float, line.rstrip().split('\t')[2:])))
-	return sample
+		sample = list(itertools.islice(f, n_lines_sample))
+		w = math.exp(math.log(random.random()) / n_lines_sample)
+		while len(sample) == n_lines_sample:
+			skip = int(math.log(random.random()) / math.log(1 - w)) # number of lines to pass before the next one enters the reservoir
+			line = next(itertools.islice(f, skip, skip + 1), None)
+			if not line:
+				break
+			sample[random.randrange(n_lines_sample)] = line
+			w *= math.exp(math.log(random.random()) / n_lines_sample)
+	return [numpy.fromstring(line.rstrip().split('\t', 2)[2], dtype = numpy.float32, sep = '\t') for line in sample]
 	
 def timer(): # calculate runtime
 	temp = str(time()-t_start).split('.')[0]
@@ -342,439 +874,487 @@ def make_log_file(filename, p_params = False, p_vars = False):
 
 #####################################################################################################################
 ###------the script runs from there-------------------------------------------------------
+if __name__ == '__main__': # the processes started by the forkserver import this file without running the script
+	if 'forkserver' in multiprocessing.get_all_start_methods(): # processes are forked from a server that has imported the modules once, 
+		multiprocessing.set_start_method('forkserver') # instead of copying this process with all its arrays
 
-# parse the input
-parser = argparse.ArgumentParser()
-parser.add_argument('-n', '--name', dest = 'n', type = str, help = 'name prefix for output files', required = True)
-parser.add_argument('-d', '--directory', dest = 'd', type = str, default = './', help = 'output file directory')
-parser.add_argument('-f1', '--fastq_read_1', dest = 'f1', type = str, help = 'input read 1 fastq file')
-parser.add_argument('-f2', '--fastq_read_2', dest = 'f2', type = str, help = 'input read 2 fastq file')
-parser.add_argument('-b', '--bam', dest = 'b', type = str, help = 'input STAR-aliged bam file')
-parser.add_argument('-r', '--ref', dest = 'r', type = str, help = 'input annotation reference file in bed format')
-parser.add_argument('-i', '--intensity', dest = 'i', type = str, help = 'input intensity file')
-parser.add_argument('-s', '--signal', dest = 's', type = str, help = 'input T signal file')
-parser.add_argument('-t', '--train', dest = 't', type = str, default = 'all', help = 'mRNAs as training set')
-parser.add_argument('-m', '--model', dest = 'm', type = str, help = 'pre-trained HMM model file (must also provide the T-signal file)')
-parser.add_argument('-p', '--pa_site', dest = 'p', type = str, help = 'optional input poly(A) annotation file')
-args = parser.parse_args()  
-
-# output file directory and prefix
-prefix = args.d + args.n + '_'
-
-###-------------------------------------------------	
-if not args.m:
-	# if a pre-trained HMM model is not provided, train and predict the data
-
-	if not args.s:
-		# mode 1: f T-signal file is not provided, process data to obtain the T-signal file
-
-		if not all([args.f1, args.f2, args.b, args.r, args.i]):
-			sys.exit('Missing input files!')
-
-		# read in all files and open files for writing
-		ref = str(args.r) # reference file with annotation in bed format
-		r1_mapped = str(args.b) # Star aligned bam file
-		r1 = str(args.f1) # fastq file from read1 (un-trimmed)
-		r2 = str(args.f2) # fastq file from read2
-		r2_intensity = str(args.i) # intensity file from read2
-		Tsignal_file = prefix +'reads_wTsignal.txt'
-		f_log = make_log_file(prefix + 'log.txt', p_params = params, p_vars = vars(args))
-
-		###-------------------------------------------------	
-		# intersect mapped read1 to protein-coding genes and
-		# construct a dictionary as {unique sequencer-id for each read : [gene name]}
-		pwrite(f_log, 'Interecting read1 to protein-coding genes...')
-		proc1 = subprocess.check_output(['samtools view ' + r1_mapped + ' | wc -l'], shell=True)
-		pwrite(f_log, 'Total number of reads uniquely mapped: ' + str(proc1)) 
-		
-		if params['strand'] == '+':
-			strand_para = '-s'
-		else:
-			strand_para = '-S'
-		proc2 = subprocess.Popen(['bedtools','intersect','-abam',r1_mapped,'-b',ref,'-wa','-wb','-bed', strand_para],stdout=subprocess.PIPE)
-		
-		if args.p:
-			pwrite(f_log, 'Proceeding in two-reference mode...')
-			pA_ref = args.p
-			proc2p2 = subprocess.Popen(['bedtools','intersect','-a','stdin','-b',pA_ref,'-wa', strand_para],stdin=proc2.stdout, stdout=subprocess.PIPE)
-			proc3=subprocess.Popen(['cut','-f4,16'],stdin=proc2p2.stdout, stdout=subprocess.PIPE)
-		else:
-			pwrite(f_log, 'Proceeding in one-reference mode...')
-			proc3 = subprocess.Popen(['cut','-f4,16'],stdin=proc2.stdout, stdout=subprocess.PIPE)
-		
-		pwrite(f_log, 'Making a master dictionary...' + timer())
-		counting = 0
-		dict_dup = {} # for storing reads that intersect more than one gene
-		while(True):
-			line = proc3.stdout.readline()
-			if (proc3.poll() is not None) and (not line):
-				pwrite(f_log, str(counting) + ' reads processed...' + timer())
-				break
-			if line:
-				lst = line.strip('\n').split('\t')
-				idx = ':'.join(lst[0].split('#')[0].split(':')[-3:])
-				gene = lst[1]
-				if idx in mdict:
-					dict_dup[idx] = None
-				else:
-					mdict[idx] = [gene]
-				counting += 1
-				if counting%params['chunk'] == 0:
-					pwrite(f_log, str(counting) + ' reads processed...' + timer())
-		for key in dict_dup:
-			del mdict[key]		
-		pwrite(f_log, 'Total number of reads mapped to protein-coding genes: ' + str(counting))
-		pwrite(f_log, 'Total number of reads uniquely intersect with protein-coding genes: ' + str(len(mdict))) 
-		###------------------------------------------------
+	# parse the input
+	parser = argparse.ArgumentParser()
+	parser.add_argument('-n', '--name', dest = 'n', type = str, help = 'name prefix for output files', required = True)
+	parser.add_argument('-d', '--directory', dest = 'd', type = str, default = './', help = 'output file directory')
+	parser.add_argument('-f1', '--fastq_read_1', dest = 'f1', type = str, help = 'input read 1 fastq file')
+	parser.add_argument('-f2', '--fastq_read_2', dest = 'f2', type = str, help = 'input read 2 fastq file')
+	parser.add_argument('-b', '--bam', dest = 'b', type = str, help = 'input STAR-aliged bam file')
+	parser.add_argument('-r', '--ref', dest = 'r', type = str, help = 'input annotation reference file in bed format')
+	parser.add_argument('-i', '--intensity', dest = 'i', type = str, help = 'input intensity file')
+	parser.add_argument('-s', '--signal', dest = 's', type = str, help = 'input T signal file')
+	parser.add_argument('-t', '--train', dest = 't', type = str, default = 'all', help = 'mRNAs as training set')
+	parser.add_argument('-m', '--model', dest = 'm', type = str, help = 'pre-trained HMM model file (must also provide the T-signal file)')
+	parser.add_argument('-p', '--pa_site', dest = 'p', type = str, help = 'optional input poly(A) annotation file')
+	parser.add_argument('-v', '--verbose', dest = 'v', action = 'store_true', help = 'print the HMM model before and after training')
+	args = parser.parse_args()  
+
+	# output file directory and prefix
+	prefix = args.d + args.n + '_'
+
+	###-------------------------------------------------	
+	if not args.m:
+		# if a pre-trained HMM model is not provided, train and predict the data
+
+		if not args.s:
+			# mode 1: f T-signal file is not provided, process data to obtain the T-signal file
 
-		###------------------------------------------------	
-		# check read2 and remove those that don't have poly(T) sequence
-		# need to remove a region that is not part of poly(T)
-		# criteria: 5 combined Ts and Ns and As in the first 6nts
-		# new dictionary: {unique sequencer-id for each read : [gene name]}
-		pwrite(f_log, '\nFiltering the dictionary by examining whether read2 has a poly(A)...' + timer())
-		if params['check_pa_tail']:
+			if not all([args.f2, args.b, args.r, args.i]):
+				sys.exit('Missing input files!')
+
+			# read in all files and open files for writing
+			ref = str(args.r) # reference file with annotation in bed format
+			r1_mapped = str(args.b) # Star aligned bam file
+			r1 = args.f1 # fastq file from read1 (un-trimmed), optional
+			r2 = str(args.f2) # fastq file from read2
+			r2_intensity = str(args.i) # intensity file from read2
+			Tsignal_file = prefix +'reads_wTsignal.txt'
+			f_log = make_log_file(prefix + 'log.txt', p_params = params, p_vars = vars(args))
+
+			###-------------------------------------------------	
+			# intersect mapped read1 to protein-coding genes and
+			# construct master arrays of the packed sequencer-id and the gene of each read
+			pwrite(f_log, 'Interecting read1 to protein-coding genes...')
+			gene_ref = read_bed(ref)
+			if args.p:
+				pwrite(f_log, 'Proceeding in two-reference mode...')
+				pA_ref = read_bed(args.p)
+			else:
+				pwrite(f_log, 'Proceeding in one-reference mode...')
+			if params['strand'] == '+': # strand of the reference regions to intersect, for reads on the forward and reverse strand
+				ref_strand = {False: '+', True: '-'}
+			else:
+				ref_strand = {False: '-', True: '+'}
+		
+			pwrite(f_log, 'Making master arrays...' + timer())
 			counting = 0
-			counting_no_tail = 0
-			r2 = fread(r2)
-			with gzip.open(prefix + 'no_tail_read2.fastq.gz', 'w') as f:
-				while(True):
-					line1 = r2.readline()
-					if not line1:
-						pwrite(f_log, str(counting) + ' reads processed...' + timer())
-						break
-					else:
-						line2 = r2.readline()
-						line2 = line2[0+params['dis2T']:]
-						line2_sub = line2[0+params['dis2T']:]
-						line3 = r2.readline()
-						line4 = r2.readline()
-						idx = ':'.join(line1.split('#')[0].split(':')[-3:])
-						if idx in mdict:
-							#if (line2[:6].count('T') + line2[:6].count('N') + line2[:6].count('A')) < 5:
-							#if line2[:8].count('T') < 7:
-							if (line2_sub[:params['len_r2_T_filter']].count('T')) < (params['len_r2_T_filter'] * params['ratio_r2_T_filter']):
-								f.write(line1 + line2 + line3 + line4)
-								del mdict[idx]
-								counting_no_tail += 1
+			counting_mapped = 0
+			read_ids = []
+			gene_ids = []
+			gene_index = {} # index of each gene name in 'gene_names'
+			seqs = bytearray() # read1 sequence and QC from the bam file, 'r1_len' bases for each entry in 'read_ids'
+			quals = bytearray()
+			seq_lens = []
+			with pysam.AlignmentFile(r1_mapped, 'rb', threads = params['n_threads']) as bam:
+				for read in bam:
+					counting_mapped += 1
+					if read.is_unmapped:
+						continue
+					strand = ref_strand[read.is_reverse]
+					genes = find_overlaps(gene_ref, read.reference_name, strand, read.reference_start, read.reference_end)
+					if genes and args.p: # a read is listed once for each pair of gene and poly(A) site it intersects
+						genes = genes * len(find_overlaps(pA_ref, read.reference_name, strand, read.reference_start, read.reference_end))
+					if genes:
+						key = pack_id(read.query_name.split('#')[0].split(':')[-3:])
+						if not r1: # without the read1 fastq file, read1 sequence and QC are taken from the bam file in the same pass
+							line2 = (read.get_forward_sequence() or '')[:params['r1_len']]
+							line4 = pysam.qualities_to_qualitystring(read.get_forward_qualities() or [])[:params['r1_len']]
+							# secondary alignments may not have a sequence
+					for gene in genes:
+						read_ids.append(key)
+						gene_ids.append(gene_index.setdefault(gene, len(gene_index)))
+						if not r1:
+							seqs += line2.encode().ljust(params['r1_len'], b'\0')
+							quals += line4.encode().ljust(params['r1_len'], b'\0')
+							seq_lens.append(len(line2))
 						counting += 1
 						if counting%params['chunk'] == 0:
 							pwrite(f_log, str(counting) + ' reads processed...' + timer())
-			pwrite(f_log, 'Number of reads filtered out due to no poly(A) tail: ' + str(counting_no_tail))
-			pwrite(f_log, 'Total number of protein-coding gene-mapped reads that have poly(A) tails: ' + str(len(mdict))) 
-			r2.close()
-		else:
-			pwrite(f_log, '\t' + 'Skipped...' + '\n')
-		###------------------------------------------------
+			pwrite(f_log, str(counting) + ' reads processed...' + timer())
+			pwrite(f_log, 'Total number of reads uniquely mapped: ' + str(counting_mapped)) 
+			gene_names = sorted(gene_index, key = gene_index.get)
+			read_ids = numpy.array(read_ids, dtype = numpy.uint64)
+			gene_ids = numpy.array(gene_ids, dtype = numpy.int32)
+			order = numpy.argsort(read_ids)
+			read_ids, gene_ids = read_ids[order], gene_ids[order]
+			unique = numpy.ones(len(read_ids), dtype = bool) # remove reads that intersect more than one gene
+			unique[1:] &= read_ids[1:] != read_ids[:-1]
+			unique[:-1] &= read_ids[:-1] != read_ids[1:]
+			read_ids, gene_ids = read_ids[unique], gene_ids[unique]
+			if not r1:
+				seq_arr = numpy.frombuffer(seqs, dtype = numpy.uint8).reshape(-1, params['r1_len'])[order][unique]
+				qc_arr = numpy.frombuffer(quals, dtype = numpy.uint8).reshape(-1, params['r1_len'])[order][unique]
+				seq_lens = numpy.array(seq_lens, dtype = numpy.int32)[order][unique]
+			seqs = quals = None
+			pwrite(f_log, 'Total number of reads mapped to protein-coding genes: ' + str(counting))
+			pwrite(f_log, 'Total number of reads uniquely intersect with protein-coding genes: ' + str(len(read_ids))) 
+			###------------------------------------------------
 
-		###------------------------------------------------
-		# 1. add original read1 sequence to the dictionary item list for normalizing signal
-		# 2. pick part of the dictionary as the training set 
-		# new dictionary: {unique sequencer-id for each read : [gene name, untrimmed read1 sequence, QC of read1]}
-		pwrite(f_log, '\nAdding untrimmed read1 sequence to the filtered dictionary for normalizing signal...')
-		pwrite(f_log, 'Spliting training and testing sets...' + timer())
-		counting = 0
-		counting_dict = 0
-		counting_train = 0
-		r1 = fread(r1)
-		while(True):
-			line1 = r1.readline()
-			if not line1:
+			###------------------------------------------------	
+			# check read2 and remove those that don't have poly(T) sequence
+			# need to remove a region that is not part of poly(T)
+			# criteria: 5 combined Ts and Ns and As in the first 6nts
+			pwrite(f_log, '\nFiltering the master arrays by examining whether read2 has a poly(A)...' + timer())
+			if params['check_pa_tail']:
+				counting = 0
+				counting_no_tail = 0
+				keep = numpy.ones(len(read_ids), dtype = bool) # reads with a poly(A) tail
+				with fqread(r2) as r2, dnaio.open(prefix + 'no_tail_read2.fastq.gz', mode = 'w') as f:
+					for records in iter(lambda: list(itertools.islice(r2, 65536)), []): # check reads in batches
+						rows = find_reads([pack_id(record.name.split('#')[0].split(':')[-3:]) for record in records])
+						# the begining region of each read2, padded with spaces if the read is shorter
+						# read2 is trimmed by 'dis2T' twice here, as in earlier versions
+						start = 2 * params['dis2T']
+						line2_sub = ''.join([record.sequence[start:start + params['len_r2_T_filter']].ljust(params['len_r2_T_filter']) for record in records])
+						line2_sub = numpy.frombuffer(line2_sub.encode(), dtype = numpy.uint8).reshape(len(records), params['len_r2_T_filter'])
+						#if (line2[:6].count('T') + line2[:6].count('N') + line2[:6].count('A')) < 5:
+						#if line2[:8].count('T') < 7:
+						no_tail = numpy.count_nonzero(line2_sub == ord('T'), axis = 1) < (params['len_r2_T_filter'] * params['ratio_r2_T_filter'])
+						for j in (no_tail & (rows >= 0)).nonzero()[0]:
+							if keep[rows[j]]:
+								f.write(records[j][0+params['dis2T']:])
+								keep[rows[j]] = False
+								counting_no_tail += 1
+						counting += len(records)
+						if counting // params['chunk'] > (counting - len(records)) // params['chunk']:
+							pwrite(f_log, str(counting) + ' reads processed...' + timer())
 				pwrite(f_log, str(counting) + ' reads processed...' + timer())
-				break
+				read_ids, gene_ids = read_ids[keep], gene_ids[keep]
+				if not r1:
+					seq_arr, qc_arr, seq_lens = seq_arr[keep], qc_arr[keep], seq_lens[keep]
+				pwrite(f_log, 'Number of reads filtered out due to no poly(A) tail: ' + str(counting_no_tail))
+				pwrite(f_log, 'Total number of protein-coding gene-mapped reads that have poly(A) tails: ' + str(len(read_ids))) 
 			else:
-				line2 = r1.readline()
-				r1.readline()
-				line4 = r1.readline()
-				idx = ':'.join(line1.split('#')[0].split(':')[-3:])
-				if mdict.has_key(idx):
-					mdict[idx].extend([line2.strip('\n'), line4.strip('\n')])
-				counting += 1
-				if counting%params['chunk'] == 0:
-					pwrite(f_log, str(counting) + ' reads processed...' + timer())
-		pwrite(f_log, 'The number of reads after accquiring read1 sequence: ' + str(len(mdict))) 
-
-		# choose the set of reads as training
-		if args.t in ['fish', 'human']: # select mRNAs, use 10 fold training ratio  
-			pwrite(f_log, 'Randomly picking training set from ' + args.t + ' mRNA reads:')
-			if args.t == 'fish':
-				sele_dict = {x:mdict[x] for x in mdict if mdict[x][0][:4] == 'ENSD'}
-			elif args.t == 'human':
-				sele_dict = {x:mdict[x] for x in mdict if (mdict[x][0][:6] == 'pA_chr') or ('ENSG' in mdict[x][0])}
-			pwrite(f_log, 'The total number of ' + args.t + ' mRNA reads:' + str(len(sele_dict)))
-			if len(sele_dict) >= params['training_min']:
-				n_train_lines = min(max(int(len(sele_dict)*params['training_ratio']*10), params['training_min']), params['training_max'])
-				train_keys = random.sample(list(sele_dict.keys()), n_train_lines)
-				pwrite(f_log, str(n_train_lines) + ' ' + args.t + ' mRNA reads picked for training...')
-			else:
-				args.t = 'all'
-				pwrite(f_log, 'Not enough ' + args.t + ' mRNA reads for training. Use all mRNA reads for picking training set...')
-		if args.t == 'all': # all mRNAs
-			pwrite(f_log, 'Randomly picking a training set from all reads:')
-			if len(mdict) >= params['training_min']:
-				n_train_lines = min(max(int(len(mdict)*params['training_ratio']), params['training_min']), params['training_max'])
-				train_keys = random.sample(list(mdict.keys()), n_train_lines)
-				pwrite(f_log, str(n_train_lines) + ' mRNA reads picked for training...')
-			else:
-				pwrite(f_log, 'Not enough reads for training. Exiting...' + timer())
-				sys.exit()
-		r1.close()
-		###------------------------------------------------
+				pwrite(f_log, '\t' + 'Skipped...' + '\n')
+			###------------------------------------------------
 
-		###------------------------------------------------
-		# read intensity file and convert 4-channel intensities to single log-transformed bound T_signal
-		# output T_signal to a file
-		pwrite(f_log, '\nReading read2 intensity file...' + timer())	
-		counting = 0
-		rounds = 0
-		counting_sum = 0
-		counting_out = 0
-		chunk_temp = params['chunk']
-		train_set = []
-		line_lst = []
-		r2_intensity = fread(r2_intensity)
-		output_Tsignal = open(Tsignal_file, 'w')
-		while(1):
-			line = r2_intensity.readline()
-			if not line:
-				with concurrent.futures.ProcessPoolExecutor(params['n_threads']) as pool:
-					futures = pool.map(worker_C2T,[line_lst[n:n+params['chunk_lines']] for n in xrange(0,len(line_lst),params['chunk_lines'])])
-					for (d,l) in futures: # combine data from outputs from all processes
-						train_set.extend(l)
-						for key in d: # write converted T-signal to a file
-							output_Tsignal.write(key+'\t'+d[key][0]+'\t'+'\t'.join(map(str,d[key][1]))+'\n')
-							counting_out += 1
-					counting_sum += counting
-					pwrite(f_log, str(counting_sum) + ' reads processed...' + timer())
-				break
+			###------------------------------------------------
+			# 1. add original read1 sequence and its QC to the master arrays for normalizing signal
+			# 2. pick part of the reads as the training set 
+			pwrite(f_log, '\nAdding untrimmed read1 sequence to the filtered master arrays for normalizing signal...')
+			pwrite(f_log, 'Spliting training and testing sets...' + timer())
+			if r1:
+				counting = 0
+				seq_arr = numpy.zeros((len(read_ids), params['r1_len']), dtype = numpy.uint8)
+				qc_arr = numpy.zeros((len(read_ids), params['r1_len']), dtype = numpy.uint8)
+				has_seq = numpy.zeros(len(read_ids), dtype = bool)
+				with fqread(r1) as r1:
+					for records in iter(lambda: list(itertools.islice(r1, 65536)), []): # add reads in batches
+						rows = find_reads([pack_id(record.name.split('#')[0].split(':')[-3:]) for record in records])
+						hit = (rows >= 0).nonzero()[0]
+						# read1 sequences and QCs of the reads in the master arrays, padded with zeros if the read is shorter
+						line2 = ''.join([records[j].sequence[:params['r1_len']].ljust(params['r1_len'], '\0') for j in hit])
+						line4 = ''.join([records[j].qualities[:params['r1_len']].ljust(params['r1_len'], '\0') for j in hit])
+						seq_arr[rows[hit]] = numpy.frombuffer(line2.encode(), dtype = numpy.uint8).reshape(len(hit), params['r1_len'])
+						qc_arr[rows[hit]] = numpy.frombuffer(line4.encode(), dtype = numpy.uint8).reshape(len(hit), params['r1_len'])
+						has_seq[rows[hit]] = True
+						counting += len(records)
+						if counting // params['chunk'] > (counting - len(records)) // params['chunk']:
+							pwrite(f_log, str(counting) + ' reads processed...' + timer())
+				pwrite(f_log, str(counting) + ' reads processed...' + timer())
 			else:
-				line_lst.append(line)
-				counting += 1
-				if counting % (params['chunk_lines'] * params['n_threads']) == 0:
-					rounds += 1
-					with concurrent.futures.ProcessPoolExecutor(params['n_threads']) as pool:
-						futures = pool.map(worker_C2T,[line_lst[n:n+params['chunk_lines']] for n in xrange(0,len(line_lst),params['chunk_lines'])])
-						for (d,l) in futures: # combine data from outputs from all processes
+				pwrite(f_log, 'No read1 fastq file provided, read1 sequence in the bam file is used...')
+				if (seq_lens != params['r1_len']).any():
+					pwrite(f_log, 'Warning! ' + str(numpy.count_nonzero(seq_lens != params['r1_len'])) + ' reads in the bam file are not ' + 
+						str(params['r1_len']) + ' nt long. If read1 was trimmed before mapping, provide the un-trimmed read1 fastq file (-f1)...')
+				has_seq = seq_lens >= params['r1_nor_end'] # read1 has to cover the region for normalization
+				seq_lens = None
+			read_ids, gene_ids, seq_arr, qc_arr = read_ids[has_seq], gene_ids[has_seq], seq_arr[has_seq], qc_arr[has_seq]
+			pwrite(f_log, 'The number of reads after accquiring read1 sequence: ' + str(len(read_ids))) 
+
+			# choose the set of reads as training
+			if args.t in ['fish', 'human']: # select mRNAs, use 10 fold training ratio  
+				pwrite(f_log, 'Randomly picking training set from ' + args.t + ' mRNA reads:')
+				if args.t == 'fish':
+					sele_genes = [i for i, x in enumerate(gene_names) if x[:4] == 'ENSD']
+				elif args.t == 'human':
+					sele_genes = [i for i, x in enumerate(gene_names) if (x[:6] == 'pA_chr') or ('ENSG' in x)]
+				sele_reads = numpy.isin(gene_ids, sele_genes).nonzero()[0]
+				pwrite(f_log, 'The total number of ' + args.t + ' mRNA reads:' + str(len(sele_reads)))
+				if len(sele_reads) >= params['training_min']:
+					n_train_lines = min(max(int(len(sele_reads)*params['training_ratio']*10), params['training_min']), params['training_max'])
+					train_mask = numpy.zeros(len(read_ids), dtype = bool)
+					train_mask[random.sample(sele_reads.tolist(), n_train_lines)] = True
+					pwrite(f_log, str(n_train_lines) + ' ' + args.t + ' mRNA reads picked for training...')
+				else:
+					args.t = 'all'
+					pwrite(f_log, 'Not enough ' + args.t + ' mRNA reads for training. Use all mRNA reads for picking training set...')
+			if args.t == 'all': # all mRNAs
+				pwrite(f_log, 'Randomly picking a training set from all reads:')
+				if len(read_ids) >= params['training_min']:
+					n_train_lines = min(max(int(len(read_ids)*params['training_ratio']), params['training_min']), params['training_max'])
+					train_mask = numpy.zeros(len(read_ids), dtype = bool)
+					train_mask[random.sample(range(len(read_ids)), n_train_lines)] = True
+					pwrite(f_log, str(n_train_lines) + ' mRNA reads picked for training...')
+				else:
+					pwrite(f_log, 'Not enough reads for training. Exiting...' + timer())
+					sys.exit()
+			###------------------------------------------------
+
+			###------------------------------------------------
+			# read intensity file and convert 4-channel intensities to single log-transformed bound T_signal
+			# output T_signal to a file
+			pwrite(f_log, '\nReading read2 intensity file...' + timer())	
+			counting_sum = 0
+			counting_out = 0
+			chunk_temp = params['chunk']
+			train_set = []
+			futures = {} # chunks submitted to the pool and their numbers of lines and output blocks
+			out_slots = [] # shared memory blocks for the outputs of the chunks, reused once the outputs are written
+			free_slots = []
+			r2_intensity = fread(r2_intensity, threads = 1)
+			output_Tsignal = open(Tsignal_file, 'wb')
+			chunk_queue = queue.Queue(maxsize = 32) # chunks of lines read from the intensity file
+			reader = threading.Thread(target = read_chunks, args = (r2_intensity, chunk_queue, params['chunk_lines']))
+			reader.daemon = True
+			reader.start()
+			shm_blocks, (read_ids, gene_ids, seq_arr, train_mask), specs = share_arrays([read_ids, gene_ids, seq_arr, train_mask])
+			# the master arrays used for converting are moved to shared memory, and the pool is created once to attach them
+			with concurrent.futures.ProcessPoolExecutor(params['n_threads'], initializer = init_C2T, initargs = (specs, gene_names)) as pool:
+				while(1):
+					line_lst = chunk_queue.get()
+					if isinstance(line_lst, Exception):
+						raise line_lst
+					if line_lst and not out_slots:
+					# the output blocks are sized by the first chunk, allowing 13 characters for each T-signal
+					# a larger output is returned directly
+						n_pos = max(line.count('\t') for line in line_lst) - 2 - params['r1_len'] - params['dis2T']
+						slot_size = params['chunk_lines'] * (64 + max([len(x) for x in gene_names], default = 0) + 13 * n_pos)
+						out_slots = [shared_memory.SharedMemory(create = True, size = slot_size) for i in range(2 * params['n_threads'])]
+						free_slots = list(range(len(out_slots)))
+					if line_lst:
+						slot = free_slots.pop()
+						futures[pool.submit(worker_C2T, line_lst, (out_slots[slot].name, slot_size))] = (len(line_lst), slot)
+					if len(futures) >= 2 * params['n_threads'] or not line_lst:
+					# keep at most two chunks per process in flight, so reading the file overlaps with converting
+						done, _ = concurrent.futures.wait(futures, 
+							return_when = concurrent.futures.FIRST_COMPLETED if line_lst else concurrent.futures.ALL_COMPLETED)
+						for future in done: # combine data from outputs from all processes
+							out, n, l = future.result()
+							n_lines, slot = futures.pop(future)
 							train_set.extend(l)
-							for key in d: # write converted T-signal to a file
-								output_Tsignal.write(key+'\t'+d[key][0]+'\t'+'\t'.join(map(str,d[key][1]))+'\n')
-								counting_out += 1
-						counting_sum = counting * rounds
-						if counting_sum > chunk_temp:
+							output_Tsignal.write(out_slots[slot].buf[:out] if isinstance(out, int) else out) # write converted T-signal to a file
+							free_slots.append(slot)
+							counting_out += n
+							counting_sum += n_lines
+						if counting_sum > chunk_temp or not line_lst:
 							chunk_temp += params['chunk']
 							pwrite(f_log, str(counting_sum) + ' reads processed...' + timer())
-					line_lst = []
-					counting = 0
-		pwrite(f_log, 'The number of reads in training set after intensity-conversion: ' + str(len(train_set)))
-		pwrite(f_log, 'Total number of reads after intensity-conversion: ' + str(counting_out))
-		pwrite(f_log, 'Finished processing read2 intensity file...' + timer())
-		r2_intensity.close()
-		output_Tsignal.close()
-		mdict.clear() # clear the dictionary to free up some memory
+					if not line_lst:
+						break
+			pwrite(f_log, 'The number of reads in training set after intensity-conversion: ' + str(len(train_set)))
+			pwrite(f_log, 'Total number of reads after intensity-conversion: ' + str(counting_out))
+			pwrite(f_log, 'Finished processing read2 intensity file...' + timer())
+			r2_intensity.close()
+			output_Tsignal.close()
+			read_ids = gene_ids = seq_arr = qc_arr = train_mask = None # clear the master arrays to free up some memory
+			for shm in shm_blocks + out_slots:
+				shm.close()
+				shm.unlink()
+			shm_blocks = out_slots = []
+			###------------------------------------------------
+
 		###------------------------------------------------
+		else:
+			# mode 2: 
+			# if a T-signal file is provided, train and predict with provided T-signal data
+
+			f_log = make_log_file(prefix + 'hmm_only_log.txt', p_params = params, p_vars = vars(args))
+			pwrite(f_log, 'Starting HMM mode with provided T-signal file...' + timer())
+			if not os.path.isfile(args.s):
+				sys.exit('Error! No Tsignal file found!')
+			else:
+				Tsignal_file = args.s
+
+			# determine the set of mRNAs used for training
+			if args.t in ['fish', 'human']:
+				pwrite(f_log, 'Use ' + args.t + ' mRNA spike-in as training set...' + timer())
+				pwrite(f_log, 'Obtain ' + args.t + ' mRNA T signals and write them in a new file...')
+				sele_Tsignal_file = prefix + args.t + '_mRNA_reads_wTsignal.txt'
+				with open(sele_Tsignal_file, 'w') as f:
+					if args.t == 'fish':
+						command = 'awk \'$2 ~ \"^ENSD\"\' ' + Tsignal_file
+					elif args.t == 'human':
+						command = 'awk \'$2 ~ \"^pA_chr[XYM0-9]\" || $2 ~ \"ENSG\"\' ' + Tsignal_file
+					proc = subprocess.Popen(shlex.split(command), stdout=f).communicate()
+			
+				# estimate the number of lines by dividing the total file size by the size of first line
+				Tsignal_input = fread(sele_Tsignal_file)
+				Tsignal_input.readline()
+				line_size = int(Tsignal_input.tell())
+				Tsignal_input.seek(0,2)
+				file_size = int(Tsignal_input.tell())
+				if line_size != 0 and file_size // line_size > params['training_min']:
+					T_lines = file_size // line_size
+					params['training_ratio'] = 0.1
+				else:
+					pwrite(f_log, 'Not enough ' + args.t + ' mRNA reads for training. Use all mRNA reads for picking training set...')
+					args.t = 'all'
+			if args.t == 'all':
+				pwrite(f_log, 'Use all mRNA spike-in as training set...' + timer())
+				Tsignal_input = fread(Tsignal_file)
+				Tsignal_input.readline()
+				line_size = int(Tsignal_input.tell())
+				Tsignal_input.seek(0,2)
+				file_size = int(Tsignal_input.tell())
+				T_lines = file_size // line_size
+
+			pwrite(f_log, 'Estimated total number of reads eligible for used as training: ' + str(T_lines))
+			pwrite(f_log, 'Randomly picking eligible reads as training set:')
+			n_train_lines = min(max(int(T_lines*params['training_ratio']), params['training_min']), params['training_max'])
+			pwrite(f_log, str(n_train_lines) + ' reads picked for training...' + timer())
+			Tsignal_input.close()
+			if args.t in ['fish', 'human']:
+				train_set = lines_sampler(sele_Tsignal_file, n_train_lines)
+			else:
+				train_set = lines_sampler(Tsignal_file, n_train_lines)
+		
+
+		###------------------------------------------------
+		# initializes a gaussian hidden markov model and defines
+		# the tranisition, emission, and starting probabilities
+		print('\nTraining data with hmm...' + timer())
+
+		pi = [1.0, 0.0, 0.0, 0.0, 0.0] # initial state
+
+		if params['allow_back'] == True:
+			# The following matrix allows T states going back to non=T states.
+			Transitionmatrix = [[0.04, 0.93, 0.02, 0.01, 0.0],
+								[0.0, 0.87, 0.1, 0.02, 0.01],
+		         	           [0.0, 0.05, 0.6, 0.3, 0.05],
+		         	           [0.0, 0.01, 0.3, 0.6, 0.09],
+		         	           [0.0, 0.01, 0.01, 0.1, 0.88]]
+		else:
+			# The following matrix does not allow states going backwards.
+			Transitionmatrix = [[0.04, 0.93, 0.02, 0.01, 0.0],
+								[0.0, 0.94, 0.03, 0.02, 0.01],
+			                    [0.0, 0.0, 0.5, 0.4, 0.1],
+			                    [0.0, 0.0, 0.0, 0.6, 0.4],
+			                    [0.0, 0.0, 0.0, 0.0, 1.0]]
+		# state 0: peudo-T state
+		# state 1: definitive-T state
+		# state 2: likely-T state
+		# state 3: likely-non-T state
+		# state 4: definitive-non-T state
+
+		if params['mixed_model'] == True:
+			Emissionmatrix = [[[params['bound']*100.0, 0.0], [1.0, 1.0], [1.0, 0.0]],
+						  [[1.5, -1.0 ], [1.5, 1.5], [0.95, 0.05]],
+		                  [[1.5, -1.0 ], [1.5, 1.5], [0.75, 0.25]],
+		                  [[1.5, -1.0 ], [1.5, 1.5], [0.5, 0.5]],
+		                  [[1.5, -1.0 ], [1.5, 1.5], [0.25, 0.75]]]
+			# [p1_mean, p2,mean], [p1_std, p2_std], [P(p1), P(p2)]
+		else:
+			Emissionmatrix = [[params['bound']*100.0, 1.0],
+							  [2.0, 0.5],
+			                  [1.0, 0.5],
+			                  [-1.0, 0.5],
+			                  [-2.0, 0.5]]
+			# [mean, std]
+		hmm = hmm_arrays(Transitionmatrix, Emissionmatrix, pi)
+
+		if args.v:
+			print('Model before training:')
+			print(hmm_xml(hmm))
+		hmm = baum_welch(hmm, train_set, 10000, 0.01, params['n_threads'])
+		if args.v:
+			print('Model after training:')
+			print(hmm_xml(hmm))
+		out_hmm = prefix + 'HMM_model.txt' # HMM model
+		with open(out_hmm, 'w') as f:
+			f.write(hmm_xml(hmm))
 
-	###------------------------------------------------
 	else:
-		# mode 2: 
-		# if a T-signal file is provided, train and predict with provided T-signal data
+		# mode 3: 
+		# if a pre-trained model is provided, load the model and predict with the model
+		hmm = read_hmm(args.m)
+		f_log = make_log_file(prefix + 'prediction_only_log.txt', p_params = params, p_vars = vars(args))
+		pwrite(f_log, '\nA pre-trained HMM model is provided. No training is carried out. Starting prediction...')
+		if args.v:
+			print(hmm_xml(hmm))
+		# the model is not written again, as it is the same as the model file provided
 
-		f_log = make_log_file(prefix + 'hmm_only_log.txt', p_params = params, p_vars = vars(args))
-		pwrite(f_log, 'Starting HMM mode with provided T-signal file...' + timer())
 		if not os.path.isfile(args.s):
 			sys.exit('Error! No Tsignal file found!')
 		else:
 			Tsignal_file = args.s
 
-		# determine the set of mRNAs used for training
-		if args.t in ['fish', 'human']:
-			pwrite(f_log, 'Use ' + args.t + ' mRNA spike-in as training set...' + timer())
-			pwrite(f_log, 'Obtain ' + args.t + ' mRNA T signals and write them in a new file...')
-			sele_Tsignal_file = prefix + args.t + '_mRNA_reads_wTsignal.txt'
-			with open(sele_Tsignal_file, 'w') as f:
-				if args.t == 'fish':
-					command = 'awk \'$2 ~ \"^ENSD\"\' ' + Tsignal_file
-				elif args.t == 'human':
-					command = 'awk \'$2 ~ \"^pA_chr[XYM0-9]\" || $2 ~ \"ENSG\"\' ' + Tsignal_file
-				proc = subprocess.Popen(shlex.split(command), stdout=f).communicate()
-			
-			# estimate the number of lines by dividing the total file size by the size of first line
-			Tsignal_input = fread(sele_Tsignal_file)
-			Tsignal_input.readline()
-			line_size = int(Tsignal_input.tell())
-			Tsignal_input.seek(0,2)
-			file_size = int(Tsignal_input.tell())
-			if line_size != 0 and file_size / line_size > params['training_min']:
-				T_lines = file_size / line_size
-				params['training_ratio'] = 0.1
-			else:
-				pwrite(f_log, 'Not enough ' + args.t + ' mRNA reads for training. Use all mRNA reads for picking training set...')
-				args.t = 'all'
-		if args.t == 'all':
-			pwrite(f_log, 'Use all mRNA spike-in as training set...' + timer())
-			Tsignal_input = fread(Tsignal_file)
-			Tsignal_input.readline()
-			line_size = int(Tsignal_input.tell())
-			Tsignal_input.seek(0,2)
-			file_size = int(Tsignal_input.tell())
-			T_lines = file_size / line_size
-
-		pwrite(f_log, 'Estimated total number of reads eligible for used as training: ' + str(T_lines))
-		pwrite(f_log, 'Randomly picking eligible reads as training set:')
-		n_train_lines = min(max(int(T_lines*params['training_ratio']), params['training_min']), params['training_max'])
-		pwrite(f_log, str(n_train_lines) + ' reads picked for training...' + timer())
-		Tsignal_input.close()
-		if args.t in ['fish', 'human']:
-			train_set = lines_sampler(sele_Tsignal_file, n_train_lines)
-		else:
-			train_set = lines_sampler(Tsignal_file, n_train_lines)
-		
+	###------------------------------------------------
+
 
 	###------------------------------------------------
-	# initializes a gaussian hidden markov model and defines
-	# the tranisition, emission, and starting probabilities
-	print('\nTraining data with hmm...' + timer())
-	F = ghmm.Float()
-
-	pi = [1.0, 0.0, 0.0, 0.0, 0.0] # initial state
-
-	if params['allow_back'] == True:
-		# The following matrix allows T states going back to non=T states.
-		Transitionmatrix = [[0.04, 0.93, 0.02, 0.01, 0.0],
-							[0.0, 0.87, 0.1, 0.02, 0.01],
-	         	           [0.0, 0.05, 0.6, 0.3, 0.05],
-	         	           [0.0, 0.01, 0.3, 0.6, 0.09],
-	         	           [0.0, 0.01, 0.01, 0.1, 0.88]]
-	else:
-		# The following matrix does not allow states going backwards.
-		Transitionmatrix = [[0.04, 0.93, 0.02, 0.01, 0.0],
-							[0.0, 0.94, 0.03, 0.02, 0.01],
-		                    [0.0, 0.0, 0.5, 0.4, 0.1],
-		                    [0.0, 0.0, 0.0, 0.6, 0.4],
-		                    [0.0, 0.0, 0.0, 0.0, 1.0]]
-	# state 0: peudo-T state
-	# state 1: definitive-T state
-	# state 2: likely-T state
-	# state 3: likely-non-T state
-	# state 4: definitive-non-T state
-
-	if params['mixed_model'] == True:
-		Emissionmatrix = [[[params['bound']*100.0, 0.0], [1.0, 1.0], [1.0, 0.0]],
-					  [[1.5, -1.0 ], [1.5, 1.5], [0.95, 0.05]],
-	                  [[1.5, -1.0 ], [1.5, 1.5], [0.75, 0.25]],
-	                  [[1.5, -1.0 ], [1.5, 1.5], [0.5, 0.5]],
-	                  [[1.5, -1.0 ], [1.5, 1.5], [0.25, 0.75]]]
-		# [p1_mean, p2,mean], [p1_std, p2_std], [P(p1), P(p2)]
-		model = ghmm.HMMFromMatrices(F, ghmm.GaussianMixtureDistribution(F), Transitionmatrix, Emissionmatrix, pi)
-	else:
-		Emissionmatrix = [[params['bound']*100.0, 1.0],
-						  [2.0, 0.5],
-		                  [1.0, 0.5],
-		                  [-1.0, 0.5],
-		                  [-2.0, 0.5]]
-		# [mean, std]
-		model = ghmm.HMMFromMatrices(F, ghmm.GaussianDistribution(F), Transitionmatrix, Emissionmatrix, pi)
-
-	print('Model before training:')
-	print(model)
-	mghmm_train = ghmm.SequenceSet(F, train_set)
-	model.baumWelch(mghmm_train, 10000, 0.01)
-	print('Model after training:')
-	print(model)
-	out_hmm = prefix + 'HMM_model.txt' # HMM model
-	model.write(out_hmm)
-
-else:
-	# mode 3: 
-	# if a pre-trained model is provided, load the model and predict with the model
-	F = ghmm.Float()
-	model = ghmm.HMMOpenXML(args.m)
-	f_log = make_log_file(prefix + 'prediction_only_log.txt', p_params = params, p_vars = vars(args))
-	pwrite(f_log, '\nA pre-trained HMM model is provided. No training is carried out. Starting prediction...')
-	print(model)
-	out_hmm = prefix + 'HMM_model.txt' # HMM model
-	model.write(out_hmm)
-
-	if not os.path.isfile(args.s):
-		sys.exit('Error! No Tsignal file found!')
-	else:
-		Tsignal_file = args.s
-
-###------------------------------------------------
-
-
-###------------------------------------------------
-# output files
-output_all = open(prefix + 'all_tails.txt', 'w') # tail lengths of all tags
-output_states = open(prefix + 'hmm_states.txt', 'w') # HMM states of all tags
-output_median = open(prefix + 'median_tails_tags.txt', 'w') # median tail lengths, aggregated by genes
-output_mean = open(prefix + 'mean_tails_tags.txt', 'w') # mean tail lengths, aggregated by genes
-
-###------------------------------------------------
-# calculate tail length using the mghmm model and write them to output files
-# dict_tl structure: {gene_name : [list of tail lengths]}
-pwrite(f_log, '\nCalculating tail-lengths and writing outputs...' + timer())
-lst_tl = [] # for storing gene_name, tail-length pairs
-counting = 0
-rounds = 0
-counting_sum = 0
-counting_out = 0
-chunk_temp = params['chunk']
-Tsignal_input = fread(Tsignal_file)
-line_lst = []
-while(1):
-	line = Tsignal_input.readline()
-	if not line:
-		with concurrent.futures.ProcessPoolExecutor(params['n_threads']) as pool:
-			futures = pool.map(worker_hmm,[line_lst[n:n+params['chunk_lines']] for n in xrange(0,len(line_lst),params['chunk_lines'])])
-			for (d, l) in futures: # combine data from outputs from all processes
-				lst_tl.extend(l)
-				for key in d: # write single tail tags to the output file
-					output_all.write(d[key][0] + '\t' + key + '\t' + d[key][1] + '\n')
-					output_states.write(key + '\t' + d[key][2] + '\n')
-					counting_out += 1
-			counting_sum += counting
-			pwrite(f_log, str(counting_sum) + ' reads processed...' + timer())
-			break
+	# output files
+	output_all = open(prefix + 'all_tails.txt', 'wb', buffering = 1 << 20) # tail lengths of all tags, written as bytes formatted by 'worker_hmm'
+	output_states = open(prefix + 'hmm_states.bin', 'wb', buffering = 1 << 20) # HMM states of all tags
+	output_median = open(prefix + 'median_tails_tags.txt', 'w') # median tail lengths, aggregated by genes
+	output_mean = open(prefix + 'mean_tails_tags.txt', 'w') # mean tail lengths, aggregated by genes
+
+	###------------------------------------------------
+	# calculate tail length using the mghmm model and write them to output files
+	pwrite(f_log, '\nCalculating tail-lengths and writing outputs...' + timer())
+	tl_genes = {} # gene_name: integer label, for all genes
+	lst_labels = [] # for storing arrays of integer labels of gene_names, one for each chunk
+	lst_tails = [] # for storing arrays of tail-lengths, one for each chunk
+	counting_sum = 0
+	counting_out = 0
+	chunk_temp = params['chunk']
+	futures = deque() # chunks submitted to the pool, in the order of the file
+	chunk_queue = queue.Queue(maxsize = 32) # chunks of lines read from the T-signal file
+	if Tsignal_file.endswith('.txt'):
+		reader = threading.Thread(target = map_chunks, args = (Tsignal_file, chunk_queue, params['chunk_lines']))
 	else:
-		line_lst.append(line)
-		counting += 1
-		if counting % (params['chunk_lines'] * params['n_threads']) == 0:
-			rounds += 1
-			with concurrent.futures.ProcessPoolExecutor(params['n_threads']) as pool:
-				futures = pool.map(worker_hmm,[line_lst[n:n+params['chunk_lines']] for n in xrange(0,len(line_lst),params['chunk_lines'])])
-				for (d, l) in futures: # combine data from outputs from all processes
-					lst_tl.extend(l)
-					for key in d: # write single tail tags to the output file
-						output_all.write(d[key][0] + '\t' + key + '\t' + d[key][1] + '\n')
-						output_states.write(key + '\t' + d[key][2] + '\n')
-						counting_out += 1
-				counting_sum = counting * rounds
+		Tsignal_input = fread(Tsignal_file)
+		reader = threading.Thread(target = read_chunks, args = (Tsignal_input, chunk_queue, params['chunk_lines']))
+	reader.daemon = True
+	reader.start()
+	hmm = {key: xp.asarray(value) for key, value in hmm.items()} # on the GPU if 'use_gpu' is True
+	with (concurrent.futures.ThreadPoolExecutor(1) if params['use_gpu'] else 
+		concurrent.futures.ProcessPoolExecutor(params['n_threads'], initializer = init_hmm, initargs = (hmm,))) as pool:
+	# a single pool of processes, each loaded with the model once, is used for all chunks, 
+	# or a single thread if HMM states are decoded on the GPU
+		while(1):
+			line_lst = chunk_queue.get()
+			if isinstance(line_lst, Exception):
+				raise line_lst
+			if line_lst:
+				futures.append(pool.submit(worker_hmm, line_lst))
+			while futures and (len(futures) >= 2 * params['n_threads'] or not line_lst):
+			# keep at most two chunks per process in flight, so reading the file overlaps with decoding,
+			# and write the outputs in the order of the file
+				out_all, out_states, genes, labels, tails = futures.popleft().result()
+				ids = numpy.array([tl_genes.setdefault(gene, len(tl_genes)) for gene in genes], dtype = numpy.int32)
+				lst_labels.append(ids[labels])
+				lst_tails.append(tails)
+				output_all.write(out_all) # write single tail tags of the chunk to the output files
+				output_states.write(out_states)
+				counting_out += len(tails)
+				counting_sum += len(tails) # each line gives a tail-length
 				if counting_sum > chunk_temp:
 					chunk_temp += params['chunk']
-					pwrite(f_log, str(counting_sum) + ' reads processed...' + timer()) 
-			line_lst = []
-			counting = 0
-pwrite(f_log, 'Total number of tail-lengths written: ' + str(counting_out))
-pwrite(f_log, 'Finished calculating tail lengths...' + timer())
-Tsignal_input.close()
-output_all.close()
-output_states.close()
-
-# delete temporary file containing converted T-signal (very big)
-#subprocess.call(['rm','-f',Tsignal_file])
-
-for pair in lst_tl: # transform data for calculating median and mean tail length
-	if dict_tl.has_key(pair[0]):
-		dict_tl[pair[0]].append(pair[1])
-	else:
-		dict_tl.setdefault(pair[0],[pair[1]])
-for key in dict_tl:
-	output_median.write(key + '\t' + str(numpy.median(dict_tl[key])) + '\t' + str(len(dict_tl[key])) + '\n')		
-for key in dict_tl:
-	output_mean.write(key + '\t' + str(numpy.mean(dict_tl[key])) + '\t' + str(len(dict_tl[key])) + '\n')			
-pwrite(f_log, 'Total number of genes with tail-length written: ' + str(len(dict_tl)))
-
-output_median.close()
-output_mean.close()
-pwrite(f_log, 'Final: ' + timer())		
+					pwrite(f_log, str(counting_sum) + ' reads processed...' + timer())
+			if not line_lst:
+				break
+	pwrite(f_log, str(counting_sum) + ' reads processed...' + timer())
+	pwrite(f_log, 'Total number of tail-lengths written: ' + str(counting_out))
+	pwrite(f_log, 'Finished calculating tail lengths...' + timer())
+	if not Tsignal_file.endswith('.txt'):
+		Tsignal_input.close()
+	output_all.close()
+	output_states.close()
+
+	# delete temporary file containing converted T-signal (very big)
+	#subprocess.call(['rm','-f',Tsignal_file])
+
+	# calculate median and mean tail length of each gene at once, with an integer label for each gene
+	genes = list(tl_genes) # in the order they first appear
+	labels = numpy.concatenate(lst_labels + [numpy.zeros(0, dtype = numpy.int32)])
+	tails = numpy.concatenate(lst_tails + [numpy.zeros(0, dtype = numpy.float32)]).astype(numpy.float64)
+	counts = numpy.bincount(labels, minlength = len(genes))
+	means = numpy.bincount(labels, weights = tails, minlength = len(genes)) / counts
+	tails = tails[numpy.lexsort((tails, labels))] # sorted by gene, then by tail length
+	starts = numpy.cumsum(counts) - counts
+	medians = (tails[starts + (counts - 1) // 2] + tails[starts + counts // 2]) / 2
+	for gene, median, mean, count in zip(genes, medians.tolist(), means.tolist(), counts.tolist()): # both files are written in one pass
+		output_median.write(gene + '\t' + str(median) + '\t' + str(count) + '\n')
+		output_mean.write(gene + '\t' + str(mean) + '\t' + str(count) + '\n')
+	pwrite(f_log, 'Total number of genes with tail-length written: ' + str(len(genes)))
+
+	output_median.close()
+	output_mean.close()
+	pwrite(f_log, 'Final: ' + timer())		
 